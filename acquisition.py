@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Optional
+
+from brainflow import BoardShim
+from nptyping import NDArray, Float64
+
+from metrics import Metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class AcquisitionThread(threading.Thread):
+    # Drains the board as data arrives and hands the chunks to the processing side, waking it (via an asyncio.Event)
+    # only once enough samples for the next epoch are waiting.
+    #
+    # Note Brainflow delivers data in quite a bursty way, so cannot just wait for 1 second and process the data:
+    # 2024-07-27 08:52:21,930 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,030 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,131 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,232 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,332 - INFO - After 100ms have (24, 120) samples
+    # 2024-07-27 08:52:22,433 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,533 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,634 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,735 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:22,835 - INFO - After 100ms have (24, 120) samples
+    # 2024-07-27 08:52:22,936 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:23,037 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:23,138 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:23,238 - INFO - After 100ms have (24, 0) samples
+    # 2024-07-27 08:52:23,339 - INFO - After 100ms have (24, 121) samples
+    # So the board is polled cheaply with get_board_data_count, at an interval based on the sampling rate, and data
+    # is only fetched when there is some.
+    def __init__(self, board: BoardShim, sampling_rate: int, samples_needed: int, loop: asyncio.AbstractEventLoop,
+                 metrics: Metrics):
+        super().__init__(name="brainflow-acquisition", daemon=True)
+        self.board = board
+        # Roughly every 10 samples, within sensible limits
+        self.poll_interval = min(0.02, max(0.002, 10 / sampling_rate))
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self.chunks: deque[NDArray[Float64]] = deque()
+        self.lock = threading.Lock()
+        self.queued_samples = 0
+        self.samples_needed = samples_needed
+        self.stopping = threading.Event()
+        self.metrics = metrics
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                count = self.board.get_board_data_count()
+                if count > 0:
+                    with self.metrics.time("board_fetch"):
+                        data = self.board.get_board_data(count)
+                    self.push(data)
+            except Exception as e:
+                logger.error(f"Error fetching board data: {e}")
+            self.stopping.wait(self.poll_interval)
+
+    def push(self, chunk: NDArray[Float64]):
+        with self.lock:
+            self.chunks.append(chunk)
+            self.queued_samples += chunk.shape[1]
+            signal = self.queued_samples >= self.samples_needed
+        if signal:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def drain(self) -> list[NDArray[Float64]]:
+        with self.lock:
+            chunks = list(self.chunks)
+            self.chunks.clear()
+            self.queued_samples = 0
+        return chunks
+
+    def set_samples_needed(self, samples_needed: int):
+        # Called from the event loop once it has taken what it needs, with how many more samples make the next epoch
+        with self.lock:
+            self.samples_needed = samples_needed
+            ready = self.queued_samples >= samples_needed
+        if ready:
+            self.ready.set()
+        else:
+            self.ready.clear()
+
+    async def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join(timeout=5)
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import logging
+from typing import Optional
+
+import numpy as np
+from nptyping import NDArray, Float64
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def samples_over_threshold(runs: list[list], num_samples: int) -> int:
+    # How many of an epoch's samples the runs cover, matching the old count of over-threshold indices
+    return sum(min(end, num_samples) - max(start, 0) for start, end, _ in runs)
+
+
+class ArtifactDetector:
+    # Finds runs of samples whose filtered amplitude exceeds the threshold, e.g. blinks, reported per epoch as
+    # [start, end, peak] (end exclusive, peak the largest absolute amplitude) relative to the epoch's first sample.
+    # Each sample is only scanned once, and a run still open at the end of one epoch is carried into the next, so an
+    # event spanning epochs is reported whole: with a negative start in the epoch after it began, and an end of the
+    # epoch length while it's still going.
+    # Runs are also merged across channels, into [start, end, peak, channels] where channels is how many channels took
+    # part, keeping those seen on at least min_channels.
+    def __init__(self, num_channels: int, threshold: float = 30, min_channels: int = 1):
+        self.num_channels = num_channels
+        self.threshold = threshold
+        self.min_channels = min_channels
+        self.reset(None)
+
+    def reset(self, position: Optional[int]):
+        # Absolute stream position up to which samples have been scanned
+        self.position = position
+        # The run in progress per channel, -1 where there isn't one
+        self.open_start = np.full(self.num_channels, -1, dtype=np.int64)
+        self.open_peak = np.zeros(self.num_channels)
+        # Completed runs that could still overlap an epoch
+        self.run_channel = np.empty(0, dtype=np.int64)
+        self.run_start = np.empty(0, dtype=np.int64)
+        self.run_end = np.empty(0, dtype=np.int64)
+        self.run_peak = np.empty(0)
+
+    def detect(self, filtered: NDArray[Float64], start_position: int) -> tuple[list[list[list]], list[list]]:
+        # filtered is (channels x samples) starting at absolute stream position start_position.  Returns the runs
+        # overlapping it per channel, and merged across channels.
+        n_samples = filtered.shape[1]
+        end_position = start_position + n_samples
+        if self.position is None or not start_position <= self.position <= end_position:
+            # First epoch, or samples were skipped (e.g. an overrun), so runs can't be joined up with what came before
+            self.reset(start_position)
+        self._scan(filtered[:, self.position - start_position:], self.position)
+        self.position = end_position
+
+        # Anything that ended before this epoch won't be needed again
+        keep = self.run_end > start_position
+        self.run_channel, self.run_start, self.run_end, self.run_peak = \
+            self.run_channel[keep], self.run_start[keep], self.run_end[keep], self.run_peak[keep]
+
+        is_open = self.open_start >= 0
+        channels = np.concatenate([self.run_channel, np.flatnonzero(is_open)])
+        starts = np.concatenate([self.run_start, self.open_start[is_open]]) - start_position
+        ends = np.concatenate([self.run_end, np.full(np.count_nonzero(is_open), end_position)]) - start_position
+        peaks = np.concatenate([self.run_peak, self.open_peak[is_open]])
+        order = np.lexsort((starts, channels))
+        channels, starts, ends, peaks = channels[order], starts[order], ends[order], peaks[order]
+
+        bounds = np.searchsorted(channels, np.arange(self.num_channels + 1))
+        runs = list(zip(starts.tolist(), ends.tolist(), peaks.tolist()))
+        per_channel = [[list(run) for run in runs[bounds[i]:bounds[i + 1]]] for i in range(self.num_channels)]
+        return per_channel, self._merge(channels, starts, ends, peaks)
+
+    def _scan(self, new: NDArray[Float64], offset: int):
+        # new holds the samples not yet scanned, the first at absolute position offset
+        n_new = new.shape[1]
+        if n_new == 0:
+            return
+        magnitude = np.abs(new)
+        over = magnitude > self.threshold
+
+        # Rising and falling edges of the over-threshold mask, padded so every run has both.  np.nonzero goes row by
+        # row, so the nth start and nth end are the same run.
+        padded = np.zeros((self.num_channels, n_new + 2), dtype=np.int8)
+        padded[:, 1:-1] = over
+        edges = np.diff(padded, axis=1)
+        channel, start = np.nonzero(edges == 1)
+        end = np.nonzero(edges == -1)[1]
+
+        # Peak of each run in one pass, over the flattened magnitudes.  The extra element keeps the final end index
+        # in range.
+        if len(channel):
+            bounds = np.empty(2 * len(channel), dtype=np.int64)
+            bounds[0::2] = channel * n_new + start
+            bounds[1::2] = channel * n_new + end
+            peak = np.maximum.reduceat(np.append(magnitude.ravel(), 0), bounds)[0::2]
+        else:
+            peak = np.empty(0)
+        start = start + offset
+        end = end + offset
+
+        # Runs carried on from before these samples
+        was_open = self.open_start >= 0
+        continuing = was_open[channel] & (start == offset)
+        start[continuing] = self.open_start[channel[continuing]]
+        peak[continuing] = np.maximum(peak[continuing], self.open_peak[channel[continuing]])
+        # and those which ended exactly where the last scan did
+        ended = np.flatnonzero(was_open & ~over[:, 0])
+        ended_start = self.open_start[ended]
+        ended_peak = self.open_peak[ended]
+
+        # Runs reaching the last sample stay open
+        still_open = end == offset + n_new
+        self.open_start[:] = -1
+        self.open_peak[:] = 0
+        self.open_start[channel[still_open]] = start[still_open]
+        self.open_peak[channel[still_open]] = peak[still_open]
+
+        closed = ~still_open
+        self.run_channel = np.concatenate([self.run_channel, ended, channel[closed]])
+        self.run_start = np.concatenate([self.run_start, ended_start, start[closed]])
+        self.run_end = np.concatenate([self.run_end, np.full(len(ended), offset), end[closed]])
+        self.run_peak = np.concatenate([self.run_peak, ended_peak, peak[closed]])
+
+    def _merge(self, channels: NDArray, starts: NDArray, ends: NDArray, peaks: NDArray) -> list[list]:
+        # Overlapping runs on any channels become one
+        if len(starts) == 0:
+            return []
+        order = np.argsort(starts, kind='stable')
+        channels, starts, ends, peaks = channels[order], starts[order], ends[order], peaks[order]
+        reach = np.maximum.accumulate(ends)
+        new_group = np.concatenate([[True], starts[1:] > reach[:-1]])
+        first = np.flatnonzero(new_group)
+        group = np.cumsum(new_group) - 1
+        # Distinct channels per group
+        num_channels = np.bincount(np.unique(group * self.num_channels + channels) // self.num_channels)
+        merged = zip(starts[first].tolist(), np.maximum.reduceat(ends, first).tolist(),
+                     np.maximum.reduceat(peaks, first).tolist(), num_channels.tolist())
+        return [list(run) for run in merged if run[3] >= self.min_channels]
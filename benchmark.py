@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+from brainflow import BoardShim, BrainFlowInputParams
+from brainflow.data_filter import DataFilter
+from nptyping import NDArray, Float64
+
+from brainflow_input import BrainflowInput
+from complexity import ComplexityPool
+from features import FeatureRegistry, ALL_FEATURES
+from metrics import Metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SYNTHETIC_BOARD = -1
+
+
+class Source:
+    # EEG rows (channels x samples) to replay through the pipeline, at the rate they're replayed
+    def __init__(self, name: str, eeg: NDArray[Float64], sampling_rate: Optional[int]):
+        self.name = name
+        self.eeg = eeg
+        # None means any rate can be swept, for synthetic data
+        self.sampling_rate = sampling_rate
+
+    def board_data(self, num_channels: int, num_samples: int, sampling_rate: int) -> NDArray[Float64]:
+        # Laid out like board data: the EEG channels, then a timestamp row.  Rows and samples are tiled if the source
+        # is smaller than needed.
+        eeg = np.resize(self.eeg, (num_channels, self.eeg.shape[1]))
+        reps = -(-num_samples // eeg.shape[1])
+        eeg = np.tile(eeg, reps)[:, :num_samples]
+        timestamps = time.time() + np.arange(num_samples) / sampling_rate
+        return np.vstack([eeg, timestamps])
+
+
+def capture_synthetic(seconds: float) -> Source:
+    # Captured once and reused for every configuration, so each run sees the same data
+    logger.info(f"Capturing {seconds}s from the synthetic board")
+    board = BoardShim(SYNTHETIC_BOARD, BrainFlowInputParams())
+    board.prepare_session()
+    try:
+        board.start_stream()
+        time.sleep(seconds)
+        data = board.get_board_data()
+        board.stop_stream()
+    finally:
+        board.release_session()
+    return Source("synthetic", data[BoardShim.get_eeg_channels(SYNTHETIC_BOARD)], None)
+
+
+def load_recording(filename: str, board_id: int) -> Source:
+    data = DataFilter.read_file(filename)
+    return Source(filename, data[BoardShim.get_eeg_channels(board_id)], BoardShim.get_sampling_rate(board_id))
+
+
+async def run_config(source: Source, num_channels: int, sampling_rate: int, samples_per_epoch: int, args,
+                     epochs: int, measure_memory: bool) -> dict:
+    metrics = Metrics(window=max(epochs, 1))
+    features = FeatureRegistry([feature for feature in args.features if feature not in args.disable_features])
+    complexity_pool = ComplexityPool(args.complexity_workers, args.complexity_deadline_ms, lambda epoch_index, results, source: None)
+    hop_samples = samples_per_epoch if args.hop_samples is None else min(args.hop_samples, samples_per_epoch)
+    channel_names = [f"ch{i}" for i in range(num_channels)]
+
+    num_samples = samples_per_epoch + (epochs - 1) * hop_samples
+    data = source.board_data(num_channels, num_samples, sampling_rate)
+    chunk_samples = max(1, int(sampling_rate * args.chunk_ms / 1000))
+
+    if measure_memory:
+        tracemalloc.start()
+    try:
+        brainflow_input = BrainflowInput(SYNTHETIC_BOARD, channel_names, None, samples_per_epoch, None, ".",
+                                         lambda event_name, timestamp: None, complexity_pool, features,
+                                         hop_samples=hop_samples,
+                                         welch_segment_samples=args.welch_segment_samples,
+                                         welch_overlap_samples=args.welch_overlap_samples,
+                                         metrics=metrics, sampling_rate=sampling_rate)
+        # No board here, the data is laid out by Source.board_data
+        brainflow_input.eeg_channels = list(range(num_channels))
+        brainflow_input.timestamp_channel = num_channels
+        brainflow_input.setup_pipeline()
+
+        processed = 0
+        start = time.perf_counter()
+        # Fed in chunks, as the acquisition thread would
+        for offset in range(0, num_samples, chunk_samples):
+            brainflow_input.ingest(data[:, offset:offset + chunk_samples])
+            while len(brainflow_input.buffer) >= samples_per_epoch:
+                await brainflow_input.process_next_epoch()
+                processed += 1
+        elapsed = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+        complexity_pool.close()
+
+    return {
+        'epochs': processed,
+        'seconds': elapsed,
+        'epochsPerSecond': processed / elapsed if elapsed else None,
+        # How many times faster than the board would deliver the data
+        'realtimeFactor': num_samples / sampling_rate / elapsed if elapsed else None,
+        'stages': metrics.snapshot()['stages'],
+        'peakMemoryBytes': peak_memory,
+    }
+
+
+def git_revision() -> Optional[str]:
+    # Of this checkout, wherever the benchmark is run from
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run_benchmarks():
+    parser = argparse.ArgumentParser(description="Benchmarks the processing pipeline, without a live board")
+    parser.add_argument('--file', type=str, nargs='+', default=[], help='Recorded .brainflow.csv files to benchmark with, as well as synthetic data')
+    parser.add_argument('--file_board_id', type=int, default=0, help='The Brainflow board ID the files were recorded with')
+    parser.add_argument('--no_synthetic', action='store_true', help='Only benchmark the recorded files')
+    parser.add_argument('--capture_seconds', type=float, default=5, help='Seconds of synthetic board data to capture, then tile')
+    parser.add_argument('--channels', type=int, nargs='+', default=[1, 4, 8, 16], help='Channel counts to sweep')
+    parser.add_argument('--sampling_rates', type=int, nargs='+', default=[250, 500, 1000], help='Sampling rates to sweep, for synthetic data')
+    parser.add_argument('--samples_per_epoch', type=int, nargs='+', default=[250, 1000], help='Epoch sizes to sweep')
+    parser.add_argument('--epochs', type=int, default=20, help='Epochs to time per configuration')
+    parser.add_argument('--memory_epochs', type=int, default=5, help='Epochs to run again under tracemalloc for peak memory, 0 to skip')
+    parser.add_argument('--warmup_epochs', type=int, default=2, help='Epochs run first and discarded')
+    parser.add_argument('--chunk_ms', type=float, default=100, help='Size of the chunks data is ingested in')
+    parser.add_argument('--hop_samples', type=int, help='Sliding window hop, capped at samples_per_epoch')
+    parser.add_argument('--welch_segment_samples', type=int, help='Welch segment length for PSDs')
+    parser.add_argument('--welch_overlap_samples', type=int, default=0, help='Welch segment overlap')
+    parser.add_argument('--complexity_workers', type=int, default=0, help='Worker processes for complexity metrics, 0 to compute them inline')
+    parser.add_argument('--complexity_deadline_ms', type=float, default=60_000, help='Complexity deadline, high by default so every metric is timed')
+    parser.add_argument('--features', nargs='+', choices=ALL_FEATURES, default=ALL_FEATURES, help='Per-epoch features to compute')
+    parser.add_argument('--disable_features', nargs='+', choices=ALL_FEATURES, default=[], help='Per-epoch features to skip')
+    parser.add_argument('-o', '--output', type=str, default="benchmark.jsonl", help='JSON lines file results are appended to')
+
+    args = parser.parse_args()
+
+    # Every epoch is logged at INFO otherwise
+    logging.getLogger('brainflow_input').setLevel(logging.WARNING)
+    BoardShim.disable_board_logger()
+
+    sources = [] if args.no_synthetic else [capture_synthetic(args.capture_seconds)]
+    sources.extend(load_recording(filename, args.file_board_id) for filename in args.file)
+
+    run = {
+        'started': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+
+    with open(args.output, 'a') as f:
+        for source in sources:
+            sampling_rates = args.sampling_rates if source.sampling_rate is None else [source.sampling_rate]
+            channel_counts = args.channels if source.sampling_rate is None else [n for n in args.channels if n <= source.eeg.shape[0]]
+            for num_channels, sampling_rate, samples_per_epoch in itertools.product(channel_counts, sampling_rates, args.samples_per_epoch):
+                if args.warmup_epochs:
+                    await run_config(source, num_channels, sampling_rate, samples_per_epoch, args, args.warmup_epochs, False)
+                result = await run_config(source, num_channels, sampling_rate, samples_per_epoch, args, args.epochs, False)
+                if args.memory_epochs:
+                    memory = await run_config(source, num_channels, sampling_rate, samples_per_epoch, args, args.memory_epochs, True)
+                    result['peakMemoryBytes'] = memory['peakMemoryBytes']
+
+                record = {
+                    **run,
+                    'source': source.name,
+                    'channels': num_channels,
+                    'samplingRate': sampling_rate,
+                    'samplesPerEpoch': samples_per_epoch,
+                    'hopSamples': args.hop_samples,
+                    'complexityWorkers': args.complexity_workers,
+                    'features': [feature for feature in args.features if feature not in args.disable_features],
+                    **result,
+                }
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                epoch_p50_ms = result['stages'].get('epoch', {}).get('p50', 0) * 1000
+                peak_mb = (result['peakMemoryBytes'] or 0) / 1e6
+                logger.info(f"{source.name} channels={num_channels} sampling_rate={sampling_rate} samples_per_epoch={samples_per_epoch}: "
+                            f"{result['epochsPerSecond']:.1f} epochs/s, epoch p50 {epoch_p50_ms:.1f} ms, "
+                            f"{result['realtimeFactor']:.1f}x realtime, peak memory {peak_mb:.1f} MB")
+
+    logger.info(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmarks())
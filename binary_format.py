@@ -0,0 +1,105 @@
+import json
+import struct
+from typing import Optional
+
+import numpy as np
+
+from json_format import CustomEncoder
+from shared import EpochResult
+
+# Binary 'eeg' frame, all little-endian:
+#   header      magic b'BWEG', version u8, flags u8, num_channels u16, num_samples u32, num_freqs u32, epoch u32,
+#               metadata_length u32
+#   metadata    UTF-8 JSON: {"address": "eeg", "epoch": ..., "channels": [{channelIdx, channelName, bandPowers,
+#               artifacts, complexity}, ...]}, plus "board" when there are several, "artifacts" (merged across
+#               channels) when detected and "decimation" when decimated for the client's view, zero padded to a
+#               multiple of 4 bytes
+#   blocks      float32, each row-major (channels x n):
+#               raw (num_samples), filtered (num_samples), then if FLAG_INDICES the sample index of each raw and
+#               filtered value (num_samples each), then if either FFT flag is set freqs (num_freqs, once),
+#               fft raw power (num_freqs) if FLAG_FFT_RAW, fft filtered power (num_freqs) if FLAG_FFT_FILTERED
+# Everything after the metadata is 4-byte aligned so a browser can wrap it in a Float32Array without copying.
+# FLAG_INDICES is only set for clients that asked for a decimated view, so other frames are unchanged.
+MAGIC = b'BWEG'
+VERSION = 2
+FLAG_FFT_RAW = 1
+FLAG_FFT_FILTERED = 2
+FLAG_INDICES = 4
+HEADER = struct.Struct('<4sBBHIIII')
+
+
+def encode_eeg_frame(result: EpochResult, epoch_index: int, board: Optional[str] = None) -> bytes:
+    num_channels = len(result)
+    num_samples = result.num_samples
+    flags = 0
+    if result.fft_raw is not None:
+        flags |= FLAG_FFT_RAW
+    if result.fft_filtered is not None:
+        flags |= FLAG_FFT_FILTERED
+    freqs = result.freqs if flags else None
+    if result.raw_indices is not None:
+        flags |= FLAG_INDICES
+    num_freqs = 0 if freqs is None else len(freqs)
+
+    metadata = {
+        'address': 'eeg',
+        'epoch': epoch_index,
+        'channels': [{
+            'channelIdx': result.channel_indices[i],
+            'channelName': result.channel_names[i],
+            'bandPowers': band_powers,
+            'artifacts': result.artifacts[i],
+            'complexity': result.complexity[i],
+        } for i, band_powers in enumerate(result.band_power_dicts())]
+    }
+    if board is not None:
+        metadata['board'] = board
+    if result.merged_artifacts is not None:
+        metadata['artifacts'] = result.merged_artifacts
+    if result.decimation is not None:
+        metadata['decimation'] = result.decimation
+    metadata = json.dumps(metadata, cls=CustomEncoder).encode('utf-8')
+    metadata += b'\0' * (-len(metadata) % 4)
+
+    # Each block is already (channels x n), so just converted to float32
+    blocks = [result.raw.astype('<f4'), result.filtered.astype('<f4')]
+    if flags & FLAG_INDICES:
+        blocks += [result.raw_indices.astype('<f4'), result.filtered_indices.astype('<f4')]
+    if freqs is not None:
+        blocks.append(freqs.astype('<f4'))
+    if flags & FLAG_FFT_RAW:
+        blocks.append(result.fft_raw.astype('<f4'))
+    if flags & FLAG_FFT_FILTERED:
+        blocks.append(result.fft_filtered.astype('<f4'))
+
+    header = HEADER.pack(MAGIC, VERSION, flags, num_channels, num_samples, num_freqs, epoch_index, len(metadata))
+    return b''.join([header, metadata] + [block.tobytes() for block in blocks])
+
+
+def decode_eeg_frame(frame: bytes) -> dict:
+    # Reference decoder, mainly for Python consumers and debugging
+    magic, version, flags, num_channels, num_samples, num_freqs, epoch_index, metadata_length = HEADER.unpack_from(frame)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} EEG frame")
+    offset = HEADER.size
+    decoded = json.loads(frame[offset:offset + metadata_length].rstrip(b'\0'))
+    offset += metadata_length
+
+    def block(rows: int, cols: int):
+        nonlocal offset
+        values = np.frombuffer(frame, dtype='<f4', count=rows * cols, offset=offset).reshape(rows, cols)
+        offset += rows * cols * 4
+        return values
+
+    decoded['raw'] = block(num_channels, num_samples)
+    decoded['filtered'] = block(num_channels, num_samples)
+    if flags & FLAG_INDICES:
+        decoded['rawIndices'] = block(num_channels, num_samples)
+        decoded['filteredIndices'] = block(num_channels, num_samples)
+    if flags & (FLAG_FFT_RAW | FLAG_FFT_FILTERED):
+        decoded['freqs'] = block(1, num_freqs)[0]
+    if flags & FLAG_FFT_RAW:
+        decoded['fftRaw'] = block(num_channels, num_freqs)
+    if flags & FLAG_FFT_FILTERED:
+        decoded['fftFiltered'] = block(num_channels, num_freqs)
+    return decoded
@@ -1,41 +1,101 @@
-import json
+from __future__ import annotations
+
+import asyncio
 import logging
 import os
 import time
 from datetime import datetime
-from typing import Optional, Callable
-
-import numpy as np
-import antropy as ant
-import mne
+from typing import Optional, Callable, List, TYPE_CHECKING
 
-from brainflow import BoardShim, DataFilter, DetrendOperations, FilterTypes, WindowOperations, BrainFlowInputParams
+from brainflow import BoardShim, BrainFlowInputParams
 from nptyping import NDArray, Float64
-from traitlets import List
 
-from shared import BandPowers, PerChannel, BAND_DEFINITIONS
-from websocket import WebsocketHandler
+from acquisition import AcquisitionThread
+from complexity import ComplexityPool
+from features import FeatureRegistry
+from metrics import Metrics
+from processing import EpochProcessor
+from ring_buffer import RingBuffer
+from shared import EpochResult
+from shm_ring import SharedRingWriter
+
+if TYPE_CHECKING:
+    from filters import StreamingFilterBank
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# What to do when processing falls behind real time
+OVERRUN_PROCESS_ALL = 'process_all'
+OVERRUN_SKIP_TO_LATEST = 'skip_to_latest'
+OVERRUN_DEGRADE = 'degrade'
+OVERRUN_POLICIES = [OVERRUN_PROCESS_ALL, OVERRUN_SKIP_TO_LATEST, OVERRUN_DEGRADE]
+
 class BrainflowInput:
 
-    def __init__(self, board_id: int, default_channel_names: List[str], serial_port: str, samples_per_epoch: int, streamer: str, output_dir: str, emit_event_callback: Callable[[str, float], None]):
+    def __init__(self, board_id: int, default_channel_names: List[str], serial_port: str, samples_per_epoch: int, streamer: str, output_dir: str, emit_event_callback: Callable[[str, float], None], complexity_pool: ComplexityPool, features: FeatureRegistry, max_backlog_seconds: float = 30,
+                 hop_samples: Optional[int] = None, welch_segment_samples: Optional[int] = None, welch_overlap_samples: int = 0,
+                 process_samples: bool = True, overrun_policy: str = OVERRUN_PROCESS_ALL, overrun_threshold_seconds: float = 5,
+                 metrics: Optional[Metrics] = None, sampling_rate: Optional[int] = None, name: Optional[str] = None,
+                 artifact_threshold: float = 30, artifact_min_channels: int = 1,
+                 shared_memory_name: Optional[str] = None, shared_memory_seconds: float = 60):
         BoardShim.enable_dev_board_logger()
         BoardShim.set_log_level(0)
-        BoardShim.release_all_sessions()
 
+        # Identifies this board in outputs and events when there are several, None for a single board
+        self.name = name
         self.last_data_collected = None
         self.board_id = board_id
         self.channel_names = default_channel_names
         self.serial_port = "" if serial_port is None else serial_port
         self.samples_per_epoch = samples_per_epoch
-        self.sampling_rate = BoardShim.get_sampling_rate(board_id)
+        # In sliding window mode an epoch of the last samples_per_epoch samples is processed every hop_samples
+        self.hop_samples = samples_per_epoch if hop_samples is None else hop_samples
+        if not 0 < self.hop_samples <= samples_per_epoch:
+            raise ValueError(f"hop_samples must be between 1 and samples_per_epoch ({samples_per_epoch}), got {hop_samples}")
+        self.welch_segment_samples = welch_segment_samples
+        self.welch_overlap_samples = welch_overlap_samples
+        self.artifact_threshold = artifact_threshold
+        self.artifact_min_channels = artifact_min_channels
+        # Overridable, e.g. when replaying data through the pipeline at other rates
+        self.sampling_rate = BoardShim.get_sampling_rate(board_id) if sampling_rate is None else sampling_rate
         self.board = None
         self.streamer = streamer
         self.emit_event_callback = emit_event_callback
         self.output_dir = output_dir
+        self.complexity_pool = complexity_pool
+        self.features = features
+        # Increments per processed epoch, so results delivered later (e.g. slow complexity metrics) can be matched up
+        self.epoch_index = 0
+        # Samples beyond this are dropped oldest-first rather than letting the buffer grow without limit
+        self.max_backlog_samples = max(samples_per_epoch, int(max_backlog_seconds * self.sampling_rate))
+        self.buffer: Optional[RingBuffer] = None
+        self.filtered_buffer: Optional[RingBuffer] = None
+        self.timestamp_buffer: Optional[RingBuffer] = None
+        self.eeg_channels: list[int] = BoardShim.get_eeg_channels(board_id)[:len(self.channel_names)]
+        self.timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+        # The samples (and their board timestamps) newly consumed by the last processed epoch.  In sliding window mode
+        # that's just the hop, so sinks that want every sample exactly once (raw exports, LSL) use these.
+        self.last_raw: Optional[NDArray[Float64]] = None
+        self.last_filtered: Optional[NDArray[Float64]] = None
+        self.last_timestamps: Optional[NDArray[Float64]] = None
+        self.filter_bank: Optional["StreamingFilterBank"] = None
+        self.processor: Optional[EpochProcessor] = None
+        # Only drain the board when something is going to process the data (not when just waiting)
+        self.process_samples = process_samples
+        self.acquisition: Optional[AcquisitionThread] = None
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy {overrun_policy}, available are {OVERRUN_POLICIES}")
+        self.overrun_policy = overrun_policy
+        self.overrun_threshold_samples = int(overrun_threshold_seconds * self.sampling_rate)
+        self.overrun = False
+        # Samples waiting beyond the epoch currently being processed
+        self.backlog_samples = 0
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Local processes can read the samples and features from shared memory, see shm_ring
+        self.shared_memory_name = shared_memory_name
+        self.shared_memory_seconds = shared_memory_seconds
+        self.shared_ring: Optional[SharedRingWriter] = None
 
     def connect_to_board(self, channel_names: Optional[List[str]]):
         self.emit_event("brainflow_recording_start_attempted", time.time())
@@ -43,7 +103,8 @@ class BrainflowInput:
             if channel_names is not None:
                 self.channel_names = channel_names
             logger.info("Connecting to board with channels " + str(self.channel_names))
-            BoardShim.release_all_sessions()
+            # Only our own session: release_all_sessions would also end any other boards' sessions
+            self.release_board()
             params = BrainFlowInputParams()
             params.serial_port=self.serial_port
             # params.ip_address="225.1.1.1"
@@ -70,7 +131,8 @@ class BrainflowInput:
 
             logger.info("Starting stream")
             self.board.start_stream()
-            filename = self.output_dir + os.path.sep + datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + ".brainflow.csv"
+            suffix = "" if self.name is None else "-" + self.name
+            filename = self.output_dir + os.path.sep + datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + suffix + ".brainflow.csv"
             logger.info(f"Writing to file {filename}")
             self.board.add_streamer(f"file://{filename}:w")
             if self.streamer is not None:
@@ -79,50 +141,70 @@ class BrainflowInput:
 
             self.eeg_channels = BoardShim.get_eeg_channels(self.board_id)[:len(self.channel_names)]
             logger.info(f"EEG Channels: {self.eeg_channels}")
-            self.buffer = {channel: [] for channel in self.eeg_channels}
+            if self.process_samples:
+                self.setup_pipeline()
+                self.acquisition = AcquisitionThread(self.board, self.sampling_rate, self.samples_per_epoch,
+                                                     asyncio.get_running_loop(), self.metrics)
+                self.acquisition.start()
         except Exception as e:
-            self.board = None
+            self.release_board()
             logger.error(f"Error connecting to board: {e}")
             self.emit_event("brainflow_recording_start_failed", time.time())
             raise e
 
-    async def fetch_and_process_samples(self) -> list[PerChannel]:
-        if self.board is None:
-            return []
-
-        # Data from every channel
-        # Note Brainflow delivers it in quite a bursty way, so cannot just wait for 1 second and process the data:
-        # 2024-07-27 08:52:21,930 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,030 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,131 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,232 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,332 - INFO - After 100ms have (24, 120) samples
-        # 2024-07-27 08:52:22,433 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,533 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,634 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,735 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:22,835 - INFO - After 100ms have (24, 120) samples
-        # 2024-07-27 08:52:22,936 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:23,037 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:23,138 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:23,238 - INFO - After 100ms have (24, 0) samples
-        # 2024-07-27 08:52:23,339 - INFO - After 100ms have (24, 121) samples
-
-        all_data: NDArray[Float64] = self.board.get_board_data()
+    def setup_pipeline(self):
+        # The buffers, filters and processor for self.eeg_channels, fresh for each connection.
+        # Imported here as scipy is slow to load, and not needed when just recording.
+        from filters import StreamingFilterBank
+        self.buffer = RingBuffer(len(self.eeg_channels), self.max_backlog_samples)
+        self.filtered_buffer = RingBuffer(len(self.eeg_channels), self.max_backlog_samples)
+        self.timestamp_buffer = RingBuffer(1, self.max_backlog_samples)
+        self.filter_bank = StreamingFilterBank(self.sampling_rate, len(self.eeg_channels))
+        self.processor = EpochProcessor(self.sampling_rate, self.channel_names, self.complexity_pool, self.features,
+                                        self.welch_segment_samples, self.welch_overlap_samples, self.name,
+                                        self.artifact_threshold, self.artifact_min_channels)
+        # Kept over reconnections with the same channels, so readers stay attached
+        if self.shared_memory_name is not None and (self.shared_ring is None or self.shared_ring.channel_names != self.channel_names):
+            self.close_shared_memory()
+            self.shared_ring = SharedRingWriter(self.shared_memory_name, self.channel_names, self.sampling_rate,
+                                                int(self.shared_memory_seconds * self.sampling_rate), source=self.name)
+
+    def ingest(self, all_data: NDArray[Float64]):
+        # all_data is every board channel, (board channels x samples)
+        eeg_channel_data = all_data[self.eeg_channels]
+        # Filter as samples arrive so the filter state carries across epoch boundaries
+        with self.metrics.time("filtering"):
+            filtered = self.filter_bank.process(eeg_channel_data)
+        with self.metrics.time("buffering"):
+            self.buffer.write(eeg_channel_data)
+            self.filtered_buffer.write(filtered)
+            self.timestamp_buffer.write(all_data[[self.timestamp_channel]])
+        if self.shared_ring is not None:
+            # As soon as the samples arrive, rather than waiting for the epoch
+            with self.metrics.time("shared_memory"):
+                self.shared_ring.write(eeg_channel_data, filtered, all_data[self.timestamp_channel])
+
+    async def wait_for_epoch(self, timeout: float) -> bool:
+        # True once enough samples for the next epoch have arrived, False on timeout
+        if self.acquisition is None:
+            await asyncio.sleep(timeout)
+            return False
+        return await self.acquisition.wait_until_ready(timeout)
+
+    async def fetch_and_process_samples(self) -> Optional[EpochResult]:
+        if self.board is None or self.acquisition is None:
+            return None
+
+        # Data from every channel, as collected by the acquisition thread
+        for chunk in self.acquisition.drain():
+            self.ingest(chunk)
         data_collected = time.perf_counter()
 
-        for index, channel in enumerate(self.eeg_channels):
-            self.buffer[channel].extend(all_data[channel])
-
-        samples_collected_per_channel = len(self.buffer[self.eeg_channels[0]])
-        if not all(len(self.buffer[channel]) >= self.samples_per_epoch for channel in self.eeg_channels):
+        samples_collected_per_channel = len(self.buffer)
+        if samples_collected_per_channel < self.samples_per_epoch:
             #logger.info(f"Not enough samples yet - have {samples_collected_per_channel} for first channel")
-            return []
-
-        # Just the EEG channel data
-        eeg_channel_data = all_data[self.eeg_channels]
-
-        eeg_data: list[PerChannel] = []
+            self.acquisition.set_samples_needed(self.samples_per_epoch - samples_collected_per_channel)
+            return None
 
         if self.last_data_collected is not None:
             elapsed_ms = (data_collected - self.last_data_collected) * 1000
@@ -130,136 +212,83 @@ class BrainflowInput:
             # under 1s since we may have a backlog of data in the buffer.
             #logger.info(f"Collected enough samples for epoch ({samples_collected_per_channel}) in {elapsed_ms} ms")
         self.last_data_collected = data_collected
-        start_time = time.perf_counter()
-
-        for index, channel in enumerate(self.eeg_channels):
-            channel_name = self.channel_names[index]
-
-            raw: NDArray[Float64] = np.array(self.buffer[channel][:self.samples_per_epoch])
-            mne_raw = raw.copy().reshape(1, -1)
-            # Remove processed samples from buffer
-            self.buffer[channel] = self.buffer[channel][self.samples_per_epoch:]
-
-            # Convert to MNE
-            info = mne.create_info(ch_names=[channel_name], sfreq=self.sampling_rate, ch_types='eeg')
-            # Brainflow Cyton data in uV, MNE expects V
-            mne_scaled = mne_raw / 1_000_000
-            mne_raw_array = mne.io.RawArray(mne_scaled, info)
-
-            #print("Raw (orig): ", raw[0:3])
-            #print("Raw (MNE) : ", mne_raw_array.get_data(units="µV")[0][0:3])
-
-
-            # FFT
-            mne_raw_array_microvolts = mne.io.RawArray(mne_raw_array.get_data(units="µV"), mne_raw_array.info)
-            spectrum = mne_raw_array_microvolts.compute_psd(fmax=120)
-            psds_raw, freqs_raw = spectrum.get_data(return_freqs=True)
-            fft_raw_json = {"freq": freqs_raw, "power": psds_raw[0]}
-
-            filtered_raw = mne_raw_array.get_data(units="µV")[0]
-            band_power_signal = filtered_raw.copy().astype(np.float64)
-            DataFilter.detrend(filtered_raw, DetrendOperations.LINEAR)
-            # We get a cleaner signal if we remove most of delta, which we don't care about much during waking hours anyway
-            low_cutoff = 4
-            DataFilter.perform_bandpass(filtered_raw, self.sampling_rate, low_cutoff, 40.0, 4, FilterTypes.BUTTERWORTH, 0)
-            DataFilter.perform_bandstop(filtered_raw, self.sampling_rate, 40.0, 62.0, 4, FilterTypes.BUTTERWORTH, 0)
-            DataFilter.perform_bandstop(filtered_raw, self.sampling_rate, 0.0, low_cutoff, 4, FilterTypes.BUTTERWORTH, 0)
-            mne_raw_array = mne.io.RawArray(filtered_raw.reshape(1, -1) / 1_000_000, info)
-
-            # MNE filters seem to work much less well than Brainflow's, unclear why - removing
-            # mne_raw_array.filter(l_freq=5, h_freq=40, fir_design='firwin')
-            # mne_raw_array.notch_filter(np.arange(50, 100), filter_length='auto', phase='zero')
-            filtered = mne_raw_array.get_data(units="µV")[0]
-
-            # MNE produces clearer FFTs than Brainflow
-            mne_raw_array_microvolts = mne.io.RawArray(mne_raw_array.get_data(units="µV"), mne_raw_array.info)
-            spectrum_filtered = mne_raw_array_microvolts.compute_psd(fmax=120)
-            psds_filtered, freqs_filtered = spectrum_filtered.get_data(return_freqs=True)
-            fft_filtered_json = {"freq": freqs_filtered, "power": psds_filtered[0]}
-
-            # Capturing wavelets is WIP
-            # Define frequencies of interest (1 Hz to 30 Hz at 1 Hz intervals)
-            # frequencies = np.arange(1, 31, 1)
-            # # Define number of cycles in Morlet wavelet
-            # n_cycles = frequencies / 2.  # Different number of cycles per frequency
-            # power = mne.time_frequency.tfr_array_morlet(mne_raw_array.get_data().reshape(1, 1, -1), sfreq=self.sampling_rate, freqs=frequencies, n_cycles=n_cycles, output='power')
-            #
-            # tfr = power[0, 0, :, :]
-            # wavelets_filtered_json = {"freq": frequencies.tolist(), "power": tfr.tolist()}
-            #
-            # plt.figure(figsize=(10, 6))
-            # plt.imshow(tfr, aspect='auto', origin='lower', extent=[0, tfr.shape[1], frequencies[0], frequencies[-1]])
-            # plt.colorbar(label='Power')
-            # plt.xlabel('Time (samples)')
-            # plt.ylabel('Frequency (Hz)')
-            # plt.title('Time-Frequency Representation (TFR)')
-            # plt.show()
-            # logger.info(f"Have {len(raw)} samples for channel {channel_name}")
-
-            over_threshold_indices = [i for i, sample in enumerate(filtered) if abs(sample) > 30]
-
-            # Capture all complexity signals supported by the Antropy library.
-            # Will filter to the most useful later.
-            complexity = {}
-            try:
-                x = filtered
 
-                # Calculate and store various entropy and complexity measures
-                complexity["permutation_entropy"] = ant.perm_entropy(x, normalize=True)
-                complexity["spectral_entropy"] = ant.spectral_entropy(x, sf=self.sampling_rate, method='welch', normalize=True)
-                complexity["svd_entropy"] = ant.svd_entropy(x, normalize=True)
-                complexity["approximate_entropy"] = ant.app_entropy(x)
-                # AKA SampEn as used in Automated Detection of Driver Fatigue Based on Entropy and Complexity Measures, Zhang, 2014
-                complexity["sample_entropy"] = ant.sample_entropy(x)
+        result = await self.process_next_epoch()
+        # If there's a backlog this is <= 0 and the next epoch is ready straight away
+        self.acquisition.set_samples_needed(self.samples_per_epoch - len(self.buffer))
+        return result
 
-                # Calculate and store Hjorth parameters
-                mobility, complexity_val = ant.hjorth_params(x)
-                complexity["hjorth_mobility"] = mobility
-                complexity["hjorth_complexity"] = complexity_val
+    async def process_next_epoch(self) -> EpochResult:
+        # Processes the oldest samples_per_epoch buffered samples, which the caller has checked are there
+        self.check_overrun()
 
-                # Calculate and store zero-crossings
-                complexity["num_zero_crossings"] = ant.num_zerocross(x)
+        # Zero-copy views of the next epoch, (channels x samples_per_epoch).  Consumed once processing is done.
+        epoch = self.buffer.peek(self.samples_per_epoch)
+        filtered = self.filtered_buffer.peek(self.samples_per_epoch)
 
-                # Calculate and store fractal dimensions and DFA
-                complexity["petrosian_fd"] = ant.petrosian_fd(x)
-                complexity["katz_fd"] = ant.katz_fd(x)
-                complexity["higuchi_fd"] = ant.higuchi_fd(x)
-                complexity["detrended_fluctuation_analysis"] = ant.detrended_fluctuation(x)
-
-                # Skipping Lempel-Ziv as needs a binary string
+        start_time = time.perf_counter()
 
-            except Exception as e:
-                logger.error(f"Error performing complexity: {e}")
+        # The absolute stream position, so the processor can reuse work when epochs overlap, and knows when samples
+        # were dropped between epochs
+        start_position = self.buffer.total_written - len(self.buffer)
 
-            complexity["abspow"] = abspow
+        self.epoch_index += 1
+        result = await self.processor.process(self.epoch_index, epoch, filtered, start_position)
 
+        # Views into the result, which already holds its own copy of the epoch
+        self.last_raw = result.raw[:, :self.hop_samples]
+        self.last_filtered = result.filtered[:, :self.hop_samples]
+        self.last_timestamps = self.timestamp_buffer.peek(self.hop_samples)[0].copy()
+        if self.shared_ring is not None:
+            # Every buffered sample is also in the shared ring, so the epoch started len(buffer) samples before its end
+            self.shared_ring.write_epoch(self.epoch_index, self.shared_ring.written - len(self.buffer),
+                                         float(self.last_timestamps[0]), result)
 
-            try:
-                DataFilter.detrend(band_power_signal, DetrendOperations.LINEAR)
-            except Exception as e:
-                logger.error(f"Error detrending band power signal: {e}")
-
-            band_power_values = []
-            for low, high, band_name in BAND_DEFINITIONS:
-                try:
-                    power_value = DataFilter.get_band_power(band_power_signal, low, high, self.sampling_rate)
-                except Exception as e:
-                    logger.error(f"Error computing band power for {band_name} ({low}-{high} Hz): {e}")
-                    power_value = 0.0
-                band_power_values.append(float(power_value))
-
-            eeg_data.append(PerChannel(
-                index, channel_name, raw.tolist(), filtered.tolist(), fft_raw_json, fft_filtered_json,
-                BandPowers(*band_power_values),
-                over_threshold_indices,
-                complexity
-            ))
+        # Remove processed samples from buffer.  In sliding window mode only the hop is removed, the rest is reused.
+        self.buffer.consume(self.hop_samples)
+        self.filtered_buffer.consume(self.hop_samples)
+        self.timestamp_buffer.consume(self.hop_samples)
 
         execution_time = time.perf_counter() - start_time
-        logger.info(f"Processed epoch in: {execution_time * 1000} ms")
-
-        return eeg_data
-
+        self.metrics.observe("epoch", execution_time)
+        for name, elapsed in self.features.timings_ms.items():
+            self.metrics.observe(name, elapsed / 1000)
+        self.metrics.set_gauge("backlog_seconds", self.backlog_seconds, self.name)
+        self.metrics.set_gauge("dropped_samples", self.buffer.dropped, self.name)
+        timings = ", ".join(f"{name} {elapsed:.1f}" for name, elapsed in self.features.timings_ms.items())
+        logger.info(f"Processed epoch in: {execution_time * 1000} ms ({timings})")
+
+        return result
+
+
+    @property
+    def backlog_seconds(self) -> float:
+        return self.backlog_samples / self.sampling_rate
+
+    def check_overrun(self):
+        self.backlog_samples = max(0, len(self.buffer) - self.samples_per_epoch)
+
+        if self.backlog_samples > self.overrun_threshold_samples:
+            if not self.overrun:
+                self.overrun = True
+                logger.warning(f"Processing has fallen {self.backlog_seconds:.1f}s ({self.backlog_samples} samples) behind, applying policy {self.overrun_policy}")
+                self.emit_event("overrun", time.time())
+
+            if self.overrun_policy == OVERRUN_SKIP_TO_LATEST:
+                logger.warning(f"Skipping {self.backlog_samples} samples to catch up")
+                for buffer in (self.buffer, self.filtered_buffer, self.timestamp_buffer):
+                    buffer.drop(self.backlog_samples)
+                self.backlog_samples = 0
+            elif self.overrun_policy == OVERRUN_DEGRADE:
+                # Keep shedding the most expensive feature each epoch until caught up
+                self.features.suspend_most_expensive()
+
+        # Some hysteresis, so we don't flap in and out of overrun
+        elif self.overrun and self.backlog_samples <= self.overrun_threshold_samples // 2:
+            self.overrun = False
+            logger.info(f"Caught up, backlog now {self.backlog_seconds:.1f}s")
+            self.features.resume_all()
+            self.emit_event("overrun_recovered", time.time())
 
     def close(self):
         if self.board:
@@ -268,9 +297,34 @@ class BrainflowInput:
 
             self.emit_event("brainflow_recording_file_stop", time.time())
 
+            if self.acquisition is not None:
+                self.acquisition.stop()
+                self.acquisition = None
+
             b.config_board('j')  # stop recording to SD
             b.stop_stream()
             b.release_session()
 
+    def close_shared_memory(self):
+        if self.shared_ring is not None:
+            self.shared_ring.close()
+            self.shared_ring = None
+
+    def release_board(self):
+        # Anything left over from a failed or unclosed connection of this board
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition = None
+        if self.board is not None:
+            try:
+                if self.board.is_prepared():
+                    self.board.release_session()
+            except Exception as e:
+                logger.warning(f"Error releasing board session: {e}")
+            self.board = None
+
     def emit_event(self, event_name: str, timestamp: float):
-        self.emit_event_callback(event_name, timestamp)
+        if self.name is None:
+            self.emit_event_callback(event_name, timestamp)
+        else:
+            self.emit_event_callback(event_name, timestamp, self.name)
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+from nptyping import NDArray, Float64
+
+from metrics import Metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def _antropy():
+    # antropy pulls in numba and sklearn, which take seconds to load, so it's only imported on first use - and then
+    # only in whichever process computes the metrics
+    import antropy
+    return antropy
+
+
+# Each metric returns a dict as some (Hjorth) produce more than one value.
+# These are module-level so they can be pickled into worker processes.
+
+def _permutation_entropy(x, sampling_rate):
+    return {"permutation_entropy": _antropy().perm_entropy(x, normalize=True)}
+
+
+def _spectral_entropy(x, sampling_rate):
+    return {"spectral_entropy": _antropy().spectral_entropy(x, sf=sampling_rate, method='welch', normalize=True)}
+
+
+def _svd_entropy(x, sampling_rate):
+    return {"svd_entropy": _antropy().svd_entropy(x, normalize=True)}
+
+
+def _approximate_entropy(x, sampling_rate):
+    return {"approximate_entropy": _antropy().app_entropy(x)}
+
+
+def _sample_entropy(x, sampling_rate):
+    # AKA SampEn as used in Automated Detection of Driver Fatigue Based on Entropy and Complexity Measures, Zhang, 2014
+    return {"sample_entropy": _antropy().sample_entropy(x)}
+
+
+def _hjorth(x, sampling_rate):
+    mobility, complexity_val = _antropy().hjorth_params(x)
+    return {"hjorth_mobility": mobility, "hjorth_complexity": complexity_val}
+
+
+def _num_zero_crossings(x, sampling_rate):
+    return {"num_zero_crossings": _antropy().num_zerocross(x)}
+
+
+def _petrosian_fd(x, sampling_rate):
+    return {"petrosian_fd": _antropy().petrosian_fd(x)}
+
+
+def _katz_fd(x, sampling_rate):
+    return {"katz_fd": _antropy().katz_fd(x)}
+
+
+def _higuchi_fd(x, sampling_rate):
+    return {"higuchi_fd": _antropy().higuchi_fd(x)}
+
+
+def _detrended_fluctuation(x, sampling_rate):
+    return {"detrended_fluctuation_analysis": _antropy().detrended_fluctuation(x)}
+
+
+# Capture all complexity signals supported by the Antropy library.
+# Skipping Lempel-Ziv as needs a binary string.
+COMPLEXITY_METRICS = {
+    "permutation_entropy": _permutation_entropy,
+    "spectral_entropy": _spectral_entropy,
+    "svd_entropy": _svd_entropy,
+    "approximate_entropy": _approximate_entropy,
+    "sample_entropy": _sample_entropy,
+    "hjorth": _hjorth,
+    "num_zero_crossings": _num_zero_crossings,
+    "petrosian_fd": _petrosian_fd,
+    "katz_fd": _katz_fd,
+    "higuchi_fd": _higuchi_fd,
+    "detrended_fluctuation_analysis": _detrended_fluctuation,
+}
+
+# The values the metrics produce, e.g. for fixed-schema storage
+COMPLEXITY_COLUMNS = ["permutation_entropy", "spectral_entropy", "svd_entropy", "approximate_entropy", "sample_entropy",
+                      "hjorth_mobility", "hjorth_complexity", "num_zero_crossings", "petrosian_fd", "katz_fd",
+                      "higuchi_fd", "detrended_fluctuation_analysis"]
+
+
+def compute_metric(name: str, x: NDArray[Float64], sampling_rate: int) -> dict:
+    # Plain Python numbers so results pickle cheaply and keep their int/float type for Influx
+    return {k: v.item() if isinstance(v, np.generic) else v for k, v in COMPLEXITY_METRICS[name](x, sampling_rate).items()}
+
+
+def timed_compute_metric(name: str, x: NDArray[Float64], sampling_rate: int) -> tuple[dict, float]:
+    # Timed in the worker, so the cost reported is the metric's own and excludes queueing and pickling
+    start = time.perf_counter()
+    result = compute_metric(name, x, sampling_rate)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def warm_up_metrics(metrics: list[str]):
+    # Runs each metric once on a little noise, so antropy is imported and numba has compiled them before the first
+    # epoch.  Returns nothing, as it runs in the workers and modules can't be pickled back.
+    x = np.random.default_rng(0).standard_normal(256)
+    for name in metrics:
+        compute_metric(name, x, 256)
+
+
+class ComplexityPool:
+    # Runs the antropy metrics in worker processes, fanned out per channel and per metric, so the O(n^2) ones don't
+    # block the event loop.  Anything not done by the deadline is handed to on_late_results once it finishes.
+    # With workers=0 everything is computed inline, as before.
+    # The pool can be shared between boards, so late results are passed back with the source (board) given to compute.
+    # At most one job per board, channel and metric is in flight: while one is still running past its deadline the
+    # metric is skipped for that channel in later epochs, so a pool that can't keep up doesn't queue without limit.
+    def __init__(self, workers: int, deadline_ms: float,
+                 on_late_results: Optional[Callable[[int, list[dict], Optional[str]], None]] = None,
+                 metrics: Optional[Metrics] = None):
+        self.workers = workers
+        self.deadline_ms = deadline_ms
+        self.on_late_results = on_late_results
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.late_tasks = set()
+        # (source, channel index, metric) -> its unfinished job
+        self.in_flight: dict[tuple, asyncio.Future] = {}
+        self.skipped = 0
+        self.warm_up_task: Optional[asyncio.Task] = None
+        logger.info(f"Complexity metrics using {workers} worker processes with {deadline_ms}ms deadline")
+
+    def warm_up(self, metrics: list[str]):
+        # Imports antropy and compiles the metrics ahead of the first epoch, which would otherwise take many times the
+        # deadline.  Only wherever they're computed: with workers, this process never needs antropy, and importing it
+        # here would cost seconds of startup and hundreds of MB.  With workers it happens in the background, and
+        # wait_until_warm waits for it.
+        if self.executor is None:
+            warm_up_metrics(metrics)
+        else:
+            self.warm_up_task = asyncio.create_task(self._warm_up_workers(metrics))
+
+    async def _warm_up_workers(self, metrics: list[str]):
+        # One each, as each worker takes seconds over it and so won't pick up another
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, warm_up_metrics, metrics)
+                                         for _ in range(self.workers)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error warming up complexity metrics: {result}")
+        logger.info(f"Complexity metrics warmed up in {time.perf_counter() - start:.1f}s")
+
+    async def wait_until_warm(self):
+        if self.warm_up_task is not None:
+            await self.warm_up_task
+
+    def compute_inline(self, filtered: NDArray[Float64], sampling_rate: int, metrics: list[str],
+                       timings_ms: Optional[dict] = None) -> list[dict]:
+        results = [{} for _ in range(filtered.shape[0])]
+        for channel_idx, x in enumerate(filtered):
+            for name in metrics:
+                try:
+                    values, elapsed_ms = timed_compute_metric(name, x, sampling_rate)
+                    results[channel_idx].update(values)
+                    if timings_ms is not None:
+                        timings_ms[name] = timings_ms.get(name, 0.0) + elapsed_ms
+                except Exception as e:
+                    logger.error(f"Error performing complexity {name}: {e}")
+        return results
+
+    async def compute(self, epoch_index: int, filtered: NDArray[Float64], sampling_rate: int,
+                      metrics: Optional[list[str]] = None, timings_ms: Optional[dict] = None,
+                      source: Optional[str] = None) -> list[dict]:
+        # filtered is (channels x samples).  Returns one dict of metric values per channel.
+        # Time spent per metric, summed over channels, is added to timings_ms if provided.
+        if metrics is None:
+            metrics = list(COMPLEXITY_METRICS.keys())
+        if self.executor is None:
+            return self.compute_inline(filtered, sampling_rate, metrics, timings_ms)
+        # The deadline only makes sense once the metrics are compiled
+        await self.wait_until_warm()
+
+        loop = asyncio.get_running_loop()
+        futures = {}
+        skipped = 0
+        for channel_idx in range(filtered.shape[0]):
+            # Copied so the worker gets a standalone array rather than a view into the ring buffer
+            x = np.array(filtered[channel_idx])
+            for name in metrics:
+                key = (source, channel_idx, name)
+                if key in self.in_flight:
+                    skipped += 1
+                    continue
+                future = loop.run_in_executor(self.executor, timed_compute_metric, name, x, sampling_rate)
+                futures[future] = (channel_idx, name)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda _, key=key: self.in_flight.pop(key, None))
+        if skipped:
+            self.skipped += skipped
+            logger.warning(f"Skipped {skipped} complexity metrics for epoch {epoch_index}, still computing them for an earlier epoch")
+
+        results = [{} for _ in range(filtered.shape[0])]
+        if not futures:
+            return results
+        done, pending = await asyncio.wait(futures.keys(), timeout=self.deadline_ms / 1000)
+        self._merge(done, futures, results, timings_ms)
+
+        if pending:
+            logger.warning(f"{len(pending)} complexity metrics missed the {self.deadline_ms}ms deadline for epoch {epoch_index}")
+            task = asyncio.create_task(self._deliver_late(epoch_index, pending, futures, filtered.shape[0], source))
+            self.late_tasks.add(task)
+            task.add_done_callback(self.late_tasks.discard)
+
+        return results
+
+    def _merge(self, done, futures, results: list[dict], timings_ms: Optional[dict] = None):
+        for future in done:
+            channel_idx, name = futures[future]
+            try:
+                values, elapsed_ms = future.result()
+                results[channel_idx].update(values)
+                if timings_ms is not None:
+                    timings_ms[name] = timings_ms.get(name, 0.0) + elapsed_ms
+            except Exception as e:
+                logger.error(f"Error performing complexity {name}: {e}")
+
+    async def _deliver_late(self, epoch_index: int, pending, futures, num_channels: int, source: Optional[str]):
+        await asyncio.wait(pending)
+        results = [{} for _ in range(num_channels)]
+        self._merge(pending, futures, results)
+        if self.on_late_results is not None:
+            self.on_late_results(epoch_index, results, source)
+
+    def update_metrics(self):
+        self.metrics.set_gauge("complexity_in_flight", len(self.in_flight))
+        self.metrics.set_gauge("complexity_skipped", self.skipped)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
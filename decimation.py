@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import logging
+from typing import Optional
+
+import numpy as np
+from nptyping import NDArray, Float64
+
+from shared import EpochResult
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+MINMAX = "minmax"
+LTTB = "lttb"
+DECIMATION_METHODS = [MINMAX, LTTB]
+
+
+def minmax(block: NDArray[Float64], points: int) -> tuple[NDArray[Float64], Optional[NDArray]]:
+    # (channels x n) down to about `points` samples per channel: the smallest and largest of each of points / 2
+    # equal buckets, in the order they occur, so peaks survive.  Returns the values and their sample indices, or the
+    # block and None if it's no bigger than that already.
+    num_channels, n = block.shape
+    buckets = points // 2
+    if buckets < 1 or 2 * buckets >= n:
+        return block, None
+    size = -(-n // buckets)
+    buckets = -(-n // size)
+    # Repeating the last sample to fill the last bucket doesn't change its min or max
+    padded = np.pad(block, ((0, 0), (0, buckets * size - n)), mode='edge').reshape(num_channels, buckets, size)
+    lowest = padded.argmin(axis=2)
+    highest = padded.argmax(axis=2)
+    starts = np.arange(buckets) * size
+    indices = np.empty((num_channels, 2 * buckets), dtype=np.int64)
+    indices[:, 0::2] = starts + np.minimum(lowest, highest)
+    indices[:, 1::2] = starts + np.maximum(lowest, highest)
+    np.minimum(indices, n - 1, out=indices)
+    return np.take_along_axis(block, indices, axis=1), indices
+
+
+def lttb(block: NDArray[Float64], points: int) -> tuple[NDArray[Float64], Optional[NDArray]]:
+    # Largest-Triangle-Three-Buckets: keeps the first and last samples, and from each of points - 2 buckets between
+    # them the sample making the largest triangle with the previously kept sample and the next bucket's mean.  Looks
+    # closer to the original than minmax at the same size, but is sequential over the buckets (not the channels,
+    # which are done together).  Returns as minmax does.
+    num_channels, n = block.shape
+    if points < 3 or points >= n:
+        return block, None
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    counts = np.diff(edges)
+    # Each bucket's mean, and the last sample standing in for the bucket after the last
+    mean_x = np.append((edges[:-1] + edges[1:] - 1) / 2, n - 1)
+    mean_y = np.concatenate([np.add.reduceat(block[:, 1:n - 1], edges[:-1] - 1, axis=1) / counts, block[:, -1:]], axis=1)
+
+    rows = np.arange(num_channels)
+    indices = np.empty((num_channels, points), dtype=np.int64)
+    indices[:, 0] = 0
+    indices[:, -1] = n - 1
+    kept = np.zeros(num_channels, dtype=np.int64)
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        kept_x = kept[:, None]
+        kept_y = block[rows, kept][:, None]
+        x = np.arange(start, end)
+        y = block[:, start:end]
+        # Twice the triangle area, which is all that's compared
+        area = np.abs((kept_x - mean_x[i + 1]) * (y - kept_y) - (kept_x - x) * (mean_y[:, i + 1:i + 2] - kept_y))
+        kept = start + area.argmax(axis=1)
+        indices[:, i + 1] = kept
+    return np.take_along_axis(block, indices, axis=1), indices
+
+
+DECIMATORS = {
+    MINMAX: minmax,
+    LTTB: lttb,
+}
+
+
+def trim_spectrum(freqs: NDArray[Float64], powers: list[Optional[NDArray[Float64]]], fmin: Optional[float],
+                  fmax: Optional[float], bins: Optional[int]) -> tuple[NDArray[Float64], list[Optional[NDArray[Float64]]]]:
+    # Keeps fmin to fmax (inclusive), then averages neighbouring bins down to at most `bins`.  Averaging keeps the
+    # values power densities, so they can be drawn against the full spectrum's.
+    start = 0 if fmin is None else int(np.searchsorted(freqs, fmin, side='left'))
+    end = len(freqs) if fmax is None else int(np.searchsorted(freqs, fmax, side='right'))
+    freqs = freqs[start:end]
+    powers = [None if p is None else p[:, start:end] for p in powers]
+    if bins is not None and 0 < bins < len(freqs):
+        edges = np.linspace(0, len(freqs), bins + 1).astype(np.int64)
+        counts = np.diff(edges)
+        freqs = np.add.reduceat(freqs, edges[:-1]) / counts
+        powers = [None if p is None else np.add.reduceat(p, edges[:-1], axis=1) / counts for p in powers]
+    return freqs, powers
+
+
+def parse_view(msg: dict) -> Optional[tuple]:
+    # From a 'view' command, e.g. {"command": "view", "points": 500, "decimation": "lttb", "fmin": 0, "fmax": 40,
+    # "bins": 64}.  Hashable, so clients asking for the same view share one variant.  None is the full resolution.
+    method = msg.get('decimation', MINMAX)
+    if method not in DECIMATORS:
+        raise ValueError(f"Unknown decimation {method}, available are {DECIMATION_METHODS}")
+    points = msg.get('points')
+    bins = msg.get('bins')
+    if points is not None and points < 2:
+        raise ValueError(f"points must be at least 2, got {points}")
+    if bins is not None and bins < 1:
+        raise ValueError(f"bins must be at least 1, got {bins}")
+    view = (None if points is None else method, points, msg.get('fmin'), msg.get('fmax'), bins)
+    return None if view == (None, None, None, None, None) else view
+
+
+def apply_view(result: EpochResult, view: tuple) -> EpochResult:
+    method, points, fmin, fmax, bins = view
+    raw, filtered = result.raw, result.filtered
+    raw_indices = filtered_indices = None
+    if points is not None:
+        decimate = DECIMATORS[method]
+        raw, raw_indices = decimate(raw, points)
+        filtered, filtered_indices = decimate(filtered, points)
+    freqs, (fft_raw, fft_filtered) = result.freqs, (result.fft_raw, result.fft_filtered)
+    if freqs is not None and (fmin is not None or fmax is not None or bins is not None):
+        freqs, (fft_raw, fft_filtered) = trim_spectrum(freqs, [fft_raw, fft_filtered], fmin, fmax, bins)
+    return EpochResult(result.channel_indices, result.channel_names, raw, filtered, freqs, fft_raw, fft_filtered,
+                       result.band_powers, result.artifacts, result.merged_artifacts, result.complexity,
+                       raw_indices, filtered_indices,
+                       None if raw_indices is None else {'method': method, 'samples': result.num_samples})
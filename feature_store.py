@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+from nptyping import NDArray
+
+from artifacts import samples_over_threshold
+from complexity import COMPLEXITY_COLUMNS
+from shared import BAND_NAMES, EpochResult
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SCHEMA_FILE = "schema.json"
+FORMAT_VERSION = 1
+
+# One row per (epoch, channel).  Features not computed for a row are NaN.
+COLUMNS = [
+    ("timestamp", "<f8"),
+    ("epoch", "<i8"),
+    # Index into the schema's channel list
+    ("channel", "<i2"),
+] + [(band, "<f8") for band in BAND_NAMES] + [(column, "<f8") for column in COMPLEXITY_COLUMNS] + [
+    ("over_threshold", "<i4"),
+]
+
+
+def epoch_rows(epoch_index: int, timestamp: float, result: EpochResult) -> list[dict]:
+    # A flat row per channel, as written to the offline CSVs
+    rows = []
+    for index, band_powers in enumerate(result.band_power_dicts()):
+        row = {'epoch': epoch_index, 'timestamp': timestamp, 'channel': result.channel_names[index]}
+        if band_powers is not None:
+            row.update(band_powers)
+        row.update(result.complexity[index])
+        row['over_threshold'] = samples_over_threshold(result.artifacts[index], result.num_samples)
+        rows.append(row)
+    return rows
+
+
+def read_schema(path: str) -> Optional[dict]:
+    schema_file = os.path.join(path, SCHEMA_FILE)
+    if not os.path.exists(schema_file):
+        return None
+    with open(schema_file) as f:
+        return json.load(f)
+
+
+class FeatureStoreWriter:
+    # An append-only columnar store: a directory holding schema.json and one little-endian binary file per column.
+    # Rows are buffered and appended a row group at a time.  schema.json records how many rows are complete and is
+    # replaced atomically after each row group, so readers (and a restarted writer) never see a partial one.
+    # Rows are expected to be appended in timestamp order, which the reader's range queries rely on.
+    def __init__(self, path: str, row_group_size: int = 1024, flush_interval: float = 60):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        self.schema = read_schema(path)
+        if self.schema is None:
+            self.schema = {'version': FORMAT_VERSION, 'columns': [{'name': name, 'dtype': dtype} for name, dtype in COLUMNS],
+                           'channels': [], 'rows': 0}
+        elif self.schema['columns'] != [{'name': name, 'dtype': dtype} for name, dtype in COLUMNS]:
+            raise ValueError(f"Feature store {path} has different columns, use a new directory")
+        # Discard anything past the last complete row group, e.g. from a crash mid-write
+        for name, dtype in COLUMNS:
+            column_file = self.column_file(name)
+            if os.path.exists(column_file):
+                os.truncate(column_file, self.schema['rows'] * np.dtype(dtype).itemsize)
+        # Per column, the arrays appended since the last flush
+        self.pending: dict[str, list[NDArray]] = {name: [] for name, _ in COLUMNS}
+        self.pending_rows = 0
+        self.last_flush = time.monotonic()
+        logger.info(f"Feature store at {path} has {self.schema['rows']} rows")
+
+    def column_file(self, name: str) -> str:
+        return os.path.join(self.path, name + ".bin")
+
+    def channel_index(self, channel_name: str) -> int:
+        channels = self.schema['channels']
+        if channel_name not in channels:
+            channels.append(channel_name)
+        return channels.index(channel_name)
+
+    def append(self, epoch_index: int, timestamp: float, result: EpochResult):
+        # Straight from the result's arrays, a row per channel
+        n = len(result)
+        columns = {
+            'timestamp': np.full(n, timestamp),
+            'epoch': np.full(n, epoch_index),
+            'channel': np.array([self.channel_index(name) for name in result.channel_names]),
+            'over_threshold': np.array([samples_over_threshold(runs, result.num_samples) for runs in result.artifacts]),
+        }
+        if result.band_powers is not None:
+            for index, band in enumerate(BAND_NAMES):
+                columns[band] = result.band_powers[:, index]
+        for name in COMPLEXITY_COLUMNS:
+            values = [complexity.get(name) for complexity in result.complexity]
+            if any(value is not None for value in values):
+                columns[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        self.append_columns(columns, n)
+
+    def append_rows(self, rows: list[dict]):
+        # Rows as produced by epoch_rows
+        columns = {
+            'timestamp': np.array([row['timestamp'] for row in rows]),
+            'epoch': np.array([row['epoch'] for row in rows]),
+            'channel': np.array([self.channel_index(row['channel']) for row in rows]),
+        }
+        for name, _ in COLUMNS[3:]:
+            columns[name] = np.array([np.nan if row.get(name) is None else row[name] for row in rows], dtype=np.float64)
+        self.append_columns(columns, len(rows))
+
+    def append_columns(self, columns: dict[str, NDArray], num_rows: int):
+        # Columns missing from columns are written as NaN
+        if not num_rows:
+            return
+        for name, _ in COLUMNS:
+            self.pending[name].append(columns[name] if name in columns else np.full(num_rows, np.nan))
+        self.pending_rows += num_rows
+        if self.pending_rows >= self.row_group_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending_rows:
+            return
+        for name, dtype in COLUMNS:
+            with open(self.column_file(name), 'ab') as f:
+                np.concatenate(self.pending[name]).astype(dtype).tofile(f)
+            self.pending[name] = []
+        self.schema['rows'] += self.pending_rows
+        self.pending_rows = 0
+        schema_file = os.path.join(self.path, SCHEMA_FILE)
+        with open(schema_file + ".tmp", 'w') as f:
+            json.dump(self.schema, f, indent=2)
+        os.replace(schema_file + ".tmp", schema_file)
+
+    def close(self):
+        self.flush()
+
+
+class FeatureStoreReader:
+    # Memory-maps the columns of a feature store, so only the rows a query touches are read from disk
+    def __init__(self, path: str):
+        self.path = path
+        self.schema = read_schema(path)
+        if self.schema is None:
+            raise FileNotFoundError(f"No feature store at {path}")
+        self.rows = self.schema['rows']
+        self.channels: list[str] = self.schema['channels']
+        self.dtypes = {column['name']: column['dtype'] for column in self.schema['columns']}
+        self.columns: dict[str, NDArray] = {}
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name: str) -> NDArray:
+        if name not in self.columns:
+            if self.rows == 0:
+                self.columns[name] = np.empty(0, dtype=self.dtypes[name])
+            else:
+                self.columns[name] = np.memmap(os.path.join(self.path, name + ".bin"), dtype=self.dtypes[name],
+                                               mode='r', shape=(self.rows,))
+        return self.columns[name]
+
+    def row_range(self, start: Optional[float] = None, end: Optional[float] = None) -> slice:
+        # Rows with start <= timestamp < end, found by binary search on the (sorted) timestamp column
+        timestamps = self.column('timestamp')
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = self.rows if end is None else int(np.searchsorted(timestamps, end, side='left'))
+        return slice(first, last)
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              columns: Optional[list[str]] = None, channels: Optional[list[str]] = None) -> dict[str, NDArray]:
+        # Returns the requested columns (default all) as arrays, for rows in the time range and channels
+        rows = self.row_range(start, end)
+        names = list(self.dtypes.keys()) if columns is None else columns
+        unknown = [name for name in names if name not in self.dtypes]
+        if unknown:
+            raise ValueError(f"Unknown columns {unknown}, available are {list(self.dtypes.keys())}")
+        if channels is None:
+            return {name: np.array(self.column(name)[rows]) for name in names}
+        wanted = [self.channels.index(channel) for channel in channels if channel in self.channels]
+        mask = np.isin(self.column('channel')[rows], wanted)
+        return {name: self.column(name)[rows][mask] for name in names}
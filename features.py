@@ -0,0 +1,99 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+from complexity import COMPLEXITY_METRICS
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BAND_POWERS = "band_powers"
+FFT_RAW = "fft_raw"
+FFT_FILTERED = "fft_filtered"
+THRESHOLD = "threshold"
+# Not selectable, but timed: the batched Welch call shared by band_powers, fft_raw and fft_filtered
+PSD = "psd"
+# Not selectable, but timed: wall time waiting for all the complexity metrics
+COMPLEXITY = "complexity"
+
+COMPLEXITY_FEATURES = list(COMPLEXITY_METRICS.keys())
+ALL_FEATURES = [BAND_POWERS, FFT_RAW, FFT_FILTERED, THRESHOLD] + COMPLEXITY_FEATURES
+
+
+class FeatureRegistry:
+    # Which per-epoch features are computed, and how long each took on the last epoch
+    def __init__(self, enabled: Optional[Iterable[str]] = None):
+        self.enabled = set(ALL_FEATURES)
+        # Temporarily switched off, e.g. while catching up after an overrun, without losing what the user enabled
+        self.suspended: set[str] = set()
+        if enabled is not None:
+            self.set_enabled(enabled)
+        self.timings_ms: dict[str, float] = {}
+
+    @staticmethod
+    def _check(names: Iterable[str]) -> list[str]:
+        names = list(names)
+        unknown = [name for name in names if name not in ALL_FEATURES]
+        if unknown:
+            raise ValueError(f"Unknown features {unknown}, available are {ALL_FEATURES}")
+        return names
+
+    def is_enabled(self, name: str) -> bool:
+        return name in self.enabled and name not in self.suspended
+
+    def set_enabled(self, names: Iterable[str]):
+        self.enabled = set(self._check(names))
+        logger.info(f"Enabled features: {self.enabled_features()}")
+
+    def enable(self, names: Iterable[str]):
+        self.enabled.update(self._check(names))
+        logger.info(f"Enabled features: {self.enabled_features()}")
+
+    def disable(self, names: Iterable[str]):
+        self.enabled.difference_update(self._check(names))
+        logger.info(f"Enabled features: {self.enabled_features()}")
+
+    def enabled_features(self) -> list[str]:
+        # In canonical order, for stable output
+        return [name for name in ALL_FEATURES if self.is_enabled(name)]
+
+    def enabled_complexity_metrics(self) -> list[str]:
+        return [name for name in COMPLEXITY_FEATURES if self.is_enabled(name)]
+
+    def suspend_most_expensive(self) -> Optional[str]:
+        # Suspends whichever active feature took longest on the last epoch, returning it (or None if nothing to drop)
+        candidates = [(elapsed, name) for name, elapsed in self.timings_ms.items() if self.is_enabled(name)]
+        if not candidates:
+            return None
+        _, name = max(candidates)
+        self.suspended.add(name)
+        logger.warning(f"Suspended feature {name}")
+        return name
+
+    def resume_all(self):
+        if self.suspended:
+            logger.info(f"Resuming features {sorted(self.suspended)}")
+            self.suspended.clear()
+
+    def start_epoch(self):
+        self.timings_ms = {}
+
+    def record(self, name: str, elapsed_ms: float):
+        self.timings_ms[name] = self.timings_ms.get(name, 0.0) + elapsed_ms
+
+    @contextmanager
+    def timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def status(self) -> dict:
+        return {
+            'available': ALL_FEATURES,
+            'enabled': self.enabled_features(),
+            'suspended': sorted(self.suspended),
+            'timingsMs': self.timings_ms,
+        }
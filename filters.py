@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+from nptyping import NDArray, Float64
+from scipy import signal
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# We get a cleaner signal if we remove most of delta, which we don't care about much during waking hours anyway
+LOW_CUTOFF = 4.0
+FILTER_ORDER = 4
+
+
+@lru_cache(maxsize=None)
+def design_sos(sampling_rate: int) -> NDArray[Float64]:
+    # 4-40Hz bandpass, 40-62Hz bandstop and a 0-4Hz bandstop (i.e. a highpass), all Butterworth, chained into one
+    # set of second-order sections.  Designed once per sampling rate.
+    nyquist = sampling_rate / 2
+    stages = [signal.butter(FILTER_ORDER, [LOW_CUTOFF, 40.0], btype='bandpass', fs=sampling_rate, output='sos')]
+    if 62.0 < nyquist:
+        stages.append(signal.butter(FILTER_ORDER, [40.0, 62.0], btype='bandstop', fs=sampling_rate, output='sos'))
+    else:
+        logger.warning(f"Sampling rate {sampling_rate} too low for 40-62Hz bandstop, skipping it")
+    stages.append(signal.butter(FILTER_ORDER, LOW_CUTOFF, btype='highpass', fs=sampling_rate, output='sos'))
+    return np.concatenate(stages)
+
+
+class StreamingFilterBank:
+    # Applies the filter chain across all channels at once, carrying the filter state from one block to the next so
+    # the output is continuous across epoch boundaries.
+    def __init__(self, sampling_rate: int, num_channels: int):
+        self.sampling_rate = sampling_rate
+        self.num_channels = num_channels
+        self.sos = design_sos(sampling_rate)
+        self.zi: Optional[NDArray[Float64]] = None
+
+    def process(self, block: NDArray[Float64]) -> NDArray[Float64]:
+        if block.shape[1] == 0:
+            return np.empty_like(block, dtype=np.float64)
+        if self.zi is None:
+            # Start from the steady state for the first sample rather than from zero, which stands in for the
+            # per-epoch detrend and avoids a large DC step transient at startup
+            self.zi = signal.sosfilt_zi(self.sos)[:, np.newaxis, :] * block[:, 0][np.newaxis, :, np.newaxis]
+        filtered, self.zi = signal.sosfilt(self.sos, block, axis=-1, zi=self.zi)
+        return filtered
+
+    def reset(self):
+        self.zi = None
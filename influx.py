@@ -1,63 +1,289 @@
+from __future__ import annotations
+
+import itertools
 import logging
+import math
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import deque
+from typing import Optional, Union
+
+import numpy as np
+import requests
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBServerError
+from nptyping import NDArray, Float64
 
-from shared import PerChannel, BAND_NAMES
+from artifacts import samples_over_threshold
+from metrics import Metrics
+from shared import EpochResult
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+
+def escape_key(value: str) -> str:
+    # Measurement names, tag keys/values and field keys in line protocol
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_field(value) -> Optional[str]:
+    # None for values line protocol can't represent: None, NaN and inf (e.g. entropy of a flat channel)
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else None
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def encode_line(measurement: str, tags: dict, fields: dict, time_us: int) -> Optional[str]:
+    # Fields that can't be represented are left out, and None returned if that leaves none
+    formatted = ((k, format_field(v)) for k, v in fields.items())
+    field_str = ','.join(f"{escape_key(k)}={v}" for k, v in formatted if v is not None)
+    if not field_str:
+        return None
+    tag_str = ''.join(f",{escape_key(k)}={escape_key(v)}" for k, v in tags.items())
+    return f"{escape_key(measurement)}{tag_str} {field_str} {time_us}"
+
+
+class RawBatch:
+    # Raw samples queued as arrays and only turned into line protocol on the writer thread
+    def __init__(self, raw: NDArray[Float64], timestamps: NDArray[Float64], channel_names: list[str],
+                 board: Optional[str] = None):
+        self.raw = raw
+        self.timestamps = timestamps
+        self.channel_names = channel_names
+        self.board = board
+
+    def __len__(self):
+        return self.raw.shape[0] * self.raw.shape[1]
+
+    def encode(self) -> list[str]:
+        # Brainflow timestamps are in seconds; microseconds keep samples distinct even at high sampling rates.
+        # Formatting from tolist() is quicker than numpy's char functions here.
+        times = np.rint(self.timestamps * 1_000_000).astype(np.int64).tolist()
+        lines = []
+        board_tag = "" if self.board is None else f",board={escape_key(self.board)}"
+        # Non-finite samples can't be written, but are rare enough to only check for them once per batch
+        all_finite = bool(np.isfinite(self.raw).all())
+        for name, row in zip(self.channel_names, self.raw.tolist()):
+            prefix = f"brainwave_raw{board_tag},channel={escape_key(name)} raw_data="
+            if all_finite:
+                lines.extend([f"{prefix}{value!r} {t}" for value, t in zip(row, times)])
+            else:
+                lines.extend([f"{prefix}{value!r} {t}" for value, t in zip(row, times) if math.isfinite(value)])
+        return lines
+
+
 class InfluxWriter:
-    def __init__(self, influx_url: str, influx_database: str, influx_username: str, influx_password: str):
-        self.client = InfluxDBClient(host=influx_url, username=influx_username, password=influx_password, database=influx_database, ssl=True, verify_ssl=True)
+    # Points are encoded as line protocol and queued; a background thread writes them in batches, whenever batch_size
+    # lines are waiting or flush_interval seconds have passed, so Influx latency never blocks the event loop.
+    # Batches that fail because Influx can't be reached (or has a server error) are kept in a bounded in-memory spool,
+    # overflowing to spool_file if given, and retried.  Batches it rejects (4xx) would never succeed, so are dropped.
+    # Writes time out after timeout seconds, and if the writer still falls behind, at most max_queued_batches (an
+    # epoch's points each) wait for it, with any more dropped.
+    def __init__(self, influx_url: str, influx_database: str, influx_username: str, influx_password: str,
+                 batch_size: int = 5000, flush_interval: float = 1.0, max_spool_lines: int = 100_000,
+                 spool_file: Optional[str] = None, metrics: Optional[Metrics] = None, timeout: float = 10,
+                 max_queued_batches: int = 1000):
+        self.client = InfluxDBClient(host=influx_url, username=influx_username, password=influx_password, database=influx_database, ssl=True, verify_ssl=True, timeout=timeout)
         logger.info(f"Connected to InfluxDB at {influx_url}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_spool_lines = max_spool_lines
+        self.spool_file = spool_file
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.queue: queue.Queue[Union[list[str], RawBatch]] = queue.Queue(maxsize=max_queued_batches)
+        self.queued_lines = 0
+        self.spool: deque[str] = deque()
+        self.dropped_lines = 0
+        self.rejected_lines = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="influx-writer", daemon=True)
+        self.thread.start()
 
-    async def write_to_influx(self, eeg_data: list[PerChannel], start_of_epoch: float, samples_per_epoch: int, sampling_rate: int):
-        json_body = []
-
-        for channel in eeg_data:
-            time = int((start_of_epoch + (samples_per_epoch / sampling_rate * 1000)))
+    def write_to_influx(self, result: EpochResult, start_of_epoch: float, samples_per_epoch: int, sampling_rate: int,
+                        board: Optional[str] = None):
+        epoch_time = int((start_of_epoch + (samples_per_epoch / sampling_rate * 1000)) * 1000)
+        lines = []
 
+        for index, band_powers in enumerate(result.band_power_dicts()):
             fields = {}
-            for power in BAND_NAMES:
-                fields[power] = getattr(channel.bandPowers, power)
+            if band_powers is not None:
+                fields.update(band_powers)
 
             # Retrieve and add complexity metrics from the complexity dictionary
-            for metric, value in channel.complexity.items():
-                fields[metric] = value
-
-            fields["over_threshold"] = len(channel.overThresholdIndices)
-
-            data_point = {
-                "measurement": "brainwave_epoch",
-                "tags": {
-                    "channel": channel.channelName,
-                },
-                "fields": fields,
-                "time": time
-            }
-            json_body.append(data_point)
-
-        logger.info(f"Saving {len(json_body)} points to Influx")
-        self.client.write_points(json_body, time_precision='ms')
-
-    async def write_raw_to_influx(self, eeg_data: list[PerChannel], start_of_epoch: float, samples_per_epoch: int, sampling_rate: int):
-        json_body = []
-
-        for channel in eeg_data:
-            for i, sample in enumerate(channel.raw):
-                time = int(start_of_epoch + (i / sampling_rate * 1000))
-
-                data_point = {
-                    "measurement": "brainwave_raw",
-                    "tags": {
-                        "channel": channel.channelName,
-                    },
-                    "fields": {
-                        "raw_data": sample
-                    },
-                    "time": time
-                }
-                json_body.append(data_point)
-
-        logger.info(f"Saving {len(json_body)} raw data points to Influx")
-        self.client.write_points(json_body, time_precision='ms')
+            fields.update(result.complexity[index])
+
+            fields["over_threshold"] = samples_over_threshold(result.artifacts[index], result.num_samples)
+
+            channel_name = result.channel_names[index]
+            tags = {"channel": channel_name} if board is None else {"board": board, "channel": channel_name}
+            line = encode_line("brainwave_epoch", tags, fields, epoch_time)
+            if line is not None:
+                lines.append(line)
+
+        self.enqueue(lines)
+
+    def write_sleep_to_influx(self, summary: dict, board: Optional[str] = None):
+        # A SleepAnalyser window, timestamped at its end: a point per channel, plus one for the stage if scored
+        time_us = int(summary['end'] * 1_000_000)
+        board_tags = {} if board is None else {"board": board}
+        lines = []
+        for index, channel_name in enumerate(summary['channels']):
+            fields = {}
+            if 'bandPowers' in summary:
+                fields.update(summary['bandPowers'][index])
+                fields.update({f"relative_{band}": value for band, value in summary['relativeBandPowers'][index].items()})
+            for detection in ('spindles', 'slowWaves'):
+                if detection in summary:
+                    fields[f"{detection}_count"] = summary[detection]['count'][channel_name]
+                    fields[f"{detection}_density"] = summary[detection]['density'][channel_name]
+            lines.append(encode_line("brainwave_sleep", {**board_tags, "channel": channel_name}, fields, time_us))
+        if 'stage' in summary:
+            fields = {"stage": summary['stage'], **{f"p_{stage}": p for stage, p in summary['stageProbabilities'].items()}}
+            lines.append(encode_line("brainwave_sleep_stage", board_tags, fields, time_us))
+        self.enqueue([line for line in lines if line is not None])
+
+    def write_raw_to_influx(self, raw: NDArray[Float64], timestamps: NDArray[Float64], channel_names: list[str],
+                            board: Optional[str] = None):
+        # raw is (channels x samples) and timestamps (samples,) from the board's timestamp channel.
+        # Not copied, so they mustn't be modified afterwards: BrainflowInput's last_raw and last_timestamps are views
+        # into the epoch result and a copy respectively, never written to again.
+        self.enqueue(RawBatch(raw, timestamps, list(channel_names), board))
+
+    def enqueue(self, lines: Union[list[str], RawBatch]):
+        if not len(lines):
+            return
+        with self.lock:
+            self.queued_lines += len(lines)
+        try:
+            self.queue.put_nowait(lines)
+        except queue.Full:
+            with self.lock:
+                self.queued_lines -= len(lines)
+                self.dropped_lines += len(lines)
+            logger.warning(f"Influx writer has fallen behind, dropped {len(lines)} lines")
+
+    def update_metrics(self):
+        for name, value in self.queue_depth().items():
+            self.metrics.set_gauge(f"influx_{name}", value)
+
+    def queue_depth(self) -> dict:
+        return {
+            'queued': self.queued_lines,
+            'spooled': len(self.spool),
+            'spooledOnDisk': os.path.getsize(self.spool_file) if self.spool_file and os.path.exists(self.spool_file) else 0,
+            'dropped': self.dropped_lines,
+            'rejected': self.rejected_lines,
+        }
+
+    def run(self):
+        batch: list[str] = []
+        last_flush = time.monotonic()
+        while not (self.stopping.is_set() and self.queue.empty()):
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                lines = self.queue.get(timeout=timeout)
+                with self.lock:
+                    self.queued_lines -= len(lines)
+                batch.extend(lines.encode() if isinstance(lines, RawBatch) else lines)
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                if batch or self.spool:
+                    self.flush(batch)
+                batch = []
+                last_flush = time.monotonic()
+        if batch or self.spool:
+            self.flush(batch)
+
+    def flush(self, batch: list[str]):
+        # Anything spooled from earlier failures goes first, oldest (on disk) first, so points arrive roughly in order
+        if not self.flush_disk_spool():
+            self.add_to_spool(batch)
+            return
+        spooled = len(self.spool)
+        lines = list(self.spool) + batch
+        self.spool.clear()
+        unwritten = self.write_lines(lines)
+        if unwritten:
+            logger.error(f"Error writing {len(unwritten)} lines to Influx, spooling for retry")
+            self.add_to_spool(unwritten)
+        elif spooled:
+            logger.info(f"Wrote {spooled} spooled lines to Influx")
+
+    def write_lines(self, lines: list[str]) -> list[str]:
+        # Writes batch_size lines at a time, returning those left unwritten when Influx couldn't be reached
+        for start in range(0, len(lines), self.batch_size):
+            chunk = lines[start:start + self.batch_size]
+            try:
+                with self.metrics.time("influx_write"):
+                    self.client.write_points(chunk, time_precision='u', protocol='line')
+            except (requests.exceptions.RequestException, InfluxDBServerError) as e:
+                logger.warning(f"Influx unavailable: {e}")
+                return lines[start:]
+            except Exception as e:
+                # Rejected (4xx), so retrying would just fail again and hold up everything behind it
+                self.rejected_lines += len(chunk)
+                logger.error(f"Influx rejected {len(chunk)} lines, dropping them: {e}")
+        return []
+
+    def add_to_spool(self, lines: list[str]):
+        overflow = len(self.spool) + len(lines) - self.max_spool_lines
+        if overflow > 0:
+            # The oldest go to disk, or are dropped
+            oldest = list(self.spool) + lines
+            self.spool.clear()
+            if self.spool_file:
+                with open(self.spool_file, 'a') as f:
+                    f.write('\n'.join(oldest[:overflow]) + '\n')
+            else:
+                with self.lock:
+                    self.dropped_lines += overflow
+                logger.warning(f"Influx spool full, dropped {overflow} oldest lines")
+            lines = oldest[overflow:]
+        self.spool.extend(lines)
+
+    def flush_disk_spool(self) -> bool:
+        # Writes the disk spool batch_size lines at a time, as it's unbounded and may not fit in memory.  Returns
+        # False if Influx couldn't be reached, leaving what wasn't written in the file.
+        if not self.spool_file or not os.path.exists(self.spool_file):
+            return True
+        written = 0
+        with open(self.spool_file) as f:
+            while True:
+                lines = [line.rstrip('\n') for line in itertools.islice(f, self.batch_size)]
+                lines = [line for line in lines if line]
+                if not lines:
+                    break
+                unwritten = self.write_lines(lines)
+                if unwritten:
+                    # Rewritten without what's been written, copying the rest across rather than reading it in
+                    remaining = self.spool_file + ".tmp"
+                    with open(remaining, 'w') as out:
+                        out.write('\n'.join(unwritten) + '\n')
+                        shutil.copyfileobj(f, out)
+                    os.replace(remaining, self.spool_file)
+                    logger.error(f"Error writing spooled lines to Influx, {written} written before it failed")
+                    return False
+                written += len(lines)
+        self.clear_disk_spool()
+        logger.info(f"Wrote {written} lines spooled on disk to Influx")
+        return True
+
+    def clear_disk_spool(self):
+        if self.spool_file and os.path.exists(self.spool_file):
+            os.remove(self.spool_file)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join(timeout=10)
@@ -1,55 +1,57 @@
+from __future__ import annotations
+
 import logging
+import time
 import traceback
 
-from pylsl import StreamInfo, StreamOutlet, vectorf
-from typing_extensions import List
+import numpy as np
+from nptyping import NDArray, Float64
+from pylsl import StreamInfo, StreamOutlet, local_clock
+from typing_extensions import List, Optional
 
-from shared import PerChannel
+from metrics import Metrics
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class LslWriter:
-    def __init__(self, id: str, channels: List[str], sampling_rate: int):
-        name = "brainwave-lsl"
+    def __init__(self, id: str, channels: List[str], sampling_rate: int, include_filtered: bool = False,
+                 metrics: Optional[Metrics] = None, name: str = "brainwave-lsl"):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.outlet = self.create_outlet(name, id, channels, sampling_rate)
+        # Filtered data goes out as a second stream, so recorders can pick either or both
+        self.filtered_outlet = None
+        if include_filtered:
+            self.filtered_outlet = self.create_outlet(name + "-filtered", id + "-filtered", channels, sampling_rate)
+
+    @staticmethod
+    def create_outlet(name: str, id: str, channels: List[str], sampling_rate: int) -> StreamOutlet:
         type = "EEG"
         num_channels = len(channels)
         logger.info(f"Creating LSL channel with name {name}, type {type}, id {id}, num_channels {num_channels}, sampling_rate {sampling_rate}")
-        self.info = StreamInfo(name, type, num_channels, sampling_rate, "double64", id)
-        chns = self.info.desc().append_child("channels")
+        # float32, matching what's pushed
+        info = StreamInfo(name, type, num_channels, sampling_rate, "float32", id)
+        chns = info.desc().append_child("channels")
         for chan_ix, label in enumerate(channels):
             ch = chns.append_child("channel")
             ch.append_child_value("label", label)
-            # ch.append_child_value("unit", "microvolts")
+            ch.append_child_value("unit", "microvolts")
             ch.append_child_value("type", "EEG")
             ch.append_child_value("scaling_factor", "1")
+        return StreamOutlet(info)
 
-        self.outlet = StreamOutlet(self.info)
-
-
-    async def write_to_lsl(self, eeg_data: list[PerChannel], start_of_epoch: float, samples_per_epoch: int, sampling_rate: int):
-
+    def write_to_lsl(self, raw: NDArray[Float64], filtered: NDArray[Float64], timestamps: NDArray[Float64]):
+        # raw and filtered are (channels x samples), timestamps (samples,) from Brainflow's timestamp channel.
+        # Each is pushed as a single chunk.
         try:
-            #print("now sending data...")
-            # start_time = local_clock()
-            # sent_samples = 0
-            # while True:
-            #     elapsed_time = local_clock() - start_time
-            #     required_samples = int(sampling_rate * elapsed_time) - sent_samples
-            #     for sample_ix in range(required_samples):
-            #logger.info("Sending samples to LSL")
-            samples_sent = 0
-            for x in range(len(eeg_data[0].raw)):
-                sample = vectorf()
-                for i in range(len(eeg_data)):
-                        #logger.info("Adding sample " + str(eeg_data[i].raw[x]) + " of type " + str(type(eeg_data[i].raw[x])))
-                    sample.append(eeg_data[i].raw[x])
-                #logger.info("Pushing sample " + str(sample))
-                self.outlet.push_sample(sample)
-                samples_sent += 1
-            #logger.info("Sent %d samples to LSL", samples_sent)
-            # sent_samples += required_samples
-                # await asyncio.sleep(1 / sampling_rate)
+            if raw.shape[1] == 0:
+                return
+            with self.metrics.time("lsl"):
+                # Brainflow timestamps are wall clock, LSL's are local_clock()
+                lsl_timestamps = (timestamps + (local_clock() - time.time())).tolist()
+                self.outlet.push_chunk(np.ascontiguousarray(raw.T, dtype=np.float32), lsl_timestamps)
+                if self.filtered_outlet is not None:
+                    self.filtered_outlet.push_chunk(np.ascontiguousarray(filtered.T, dtype=np.float32), lsl_timestamps)
         except Exception as e:
             logger.error(f"Error: {e}")
             traceback.print_exc()
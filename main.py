@@ -1,26 +1,50 @@
+import time
+
+# As early as possible, for the startup report
+STARTED = time.perf_counter()
+
 import argparse
 import asyncio
 import json
 import logging
+import os
 import traceback
 from datetime import datetime
-from xmlrpc.client import boolean
+from typing import Optional
 
-from brainflow_input import BrainflowInput
-from influx import InfluxWriter
+from brainflow_input import BrainflowInput, OVERRUN_POLICIES, OVERRUN_PROCESS_ALL
+from complexity import ComplexityPool, COMPLEXITY_COLUMNS
+from feature_store import FeatureStoreWriter
+from features import FeatureRegistry, ALL_FEATURES
 from json_format import CustomEncoder
-#from lsl import LslWriter
-from shared import BandPowers
+from metrics import Metrics, startup_report
+from sleep_staging import SleepAnalyser, DETECTIONS, warm_up as warm_up_sleep
 from websocket import WebsocketHandler
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+class BoardSpec:
+    # One board from --board BOARD_ID:CHANNELS[:SERIAL_PORT[:NAME]], e.g. 0:F3,T4:/dev/ttyUSB0:cyton
+    def __init__(self, spec: str):
+        parts = spec.split(':')
+        if len(parts) < 2 or len(parts) > 4:
+            raise argparse.ArgumentTypeError(f"Expected BOARD_ID:CHANNELS[:SERIAL_PORT[:NAME]], got {spec}")
+        self.board_id = int(parts[0])
+        self.channels = parts[1].split(',')
+        self.serial_port = parts[2] if len(parts) > 2 and parts[2] else None
+        self.name = parts[3] if len(parts) > 3 and parts[3] else None
+
+
 async def run_brainflow():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-b', '--board_id', type=int, required=True, help='The Brainflow board ID to connect to')
-    parser.add_argument('-c', '--channels', nargs='+', required=True, help='Specify channel names')
+    parser.add_argument('-b', '--board_id', type=int, help='The Brainflow board ID to connect to')
+    parser.add_argument('-c', '--channels', nargs='+', help='Specify channel names')
+    parser.add_argument('--board', type=BoardSpec, action='append', default=[], metavar='BOARD_ID:CHANNELS[:SERIAL_PORT[:NAME]]',
+                        help='A board to run, instead of --board_id/--channels/--serial_port.  Repeat for several boards in one process, '
+                             'e.g. --board 0:F3,T4:/dev/ttyUSB0:cyton --board 23:C3,C4,CP3,CP4,F5,F6,PO3,PO4::crown.  '
+                             'Negative board IDs need an equals sign: --board=-1:F3,T4')
     parser.add_argument('-j', '--just_wait', action='store_true',
                         help='Just waits, does not take commands or do any processing')
     parser.add_argument('-w', '--wait_for_commands', action='store_true', help='Wait for directions over websocket')
@@ -28,99 +52,314 @@ async def run_brainflow():
                         help='Serial port e.g. /dev/ttyUSB0 (Linux) or COM11 (Windows)')
     parser.add_argument('-wp', '--websocket_port', type=int, help='Websocket port')
     parser.add_argument('-spe', '--samples_per_epoch', type=int, default=250, help='Samples per epoch')
+    parser.add_argument('--hop_samples', type=int, help='Sliding window mode: process the last samples_per_epoch samples every this many samples')
+    parser.add_argument('--welch_segment_samples', type=int, help='Welch segment length for PSDs, defaults to the whole epoch (capped at 2048)')
+    parser.add_argument('--welch_overlap_samples', type=int, default=0, help='Welch segment overlap.  With --hop_samples a multiple of segment minus overlap, segments are reused between windows')
+    parser.add_argument('--artifact_threshold', type=float, default=30, help='Filtered amplitude (uV) above which samples are reported as artifact runs, e.g. blinks')
+    parser.add_argument('--artifact_min_channels', type=int, default=1, help='Artifacts merged across channels are only reported when seen on at least this many channels')
+    parser.add_argument('--max_backlog_seconds', type=float, default=30, help='Maximum unprocessed data to buffer before the oldest samples are dropped')
+    parser.add_argument('--overrun_policy', choices=OVERRUN_POLICIES, default=OVERRUN_PROCESS_ALL, help='When processing falls behind: process everything, skip to the latest epoch, or drop the most expensive features until caught up')
+    parser.add_argument('--overrun_threshold_seconds', type=float, default=5, help='Backlog that counts as an overrun')
+    parser.add_argument('--complexity_workers', type=int, default=max(1, (os.cpu_count() or 2) - 1), help='Worker processes for complexity metrics, 0 to compute them inline')
+    parser.add_argument('--complexity_deadline_ms', type=float, default=500, help='Complexity metrics not done by this deadline are sent in a later "complexity" message')
+    parser.add_argument('--features', nargs='+', choices=ALL_FEATURES, default=ALL_FEATURES, help='Per-epoch features to compute')
+    parser.add_argument('--disable_features', nargs='+', choices=ALL_FEATURES, default=[], help='Per-epoch features to skip')
     parser.add_argument('-f', '--save_to_brainflow_file', type=str, help="Save the raw unprocessed data to file")
     parser.add_argument('-o', '--output_dir', type=str, default=".", help="Where to save files")
+    parser.add_argument('--sleep', action='store_true', help='Long-window sleep analysis, sent as "sleep" messages and to InfluxDB every --sleep_window_seconds')
+    parser.add_argument('--sleep_window_seconds', type=float, default=30, help='Sleep scoring window')
+    parser.add_argument('--sleep_history_minutes', type=float, default=10, help='History kept for sleep staging and the rolling aggregates')
+    parser.add_argument('--sleep_staging_channel', type=str, help='Channel to score sleep stages from with yasa, once 5 minutes of history are in')
+    parser.add_argument('--sleep_detect', nargs='+', choices=DETECTIONS, default=[], help='yasa detections to run on each sleep window')
     parser.add_argument('--mqtt_url', type=str, help='MQTT URL')
     parser.add_argument('--mqtt_username', type=str, help='MQTT username')
     parser.add_argument('--mqtt_password', type=str, help='MQTT password')
+    parser.add_argument('--mqtt_topic', type=str, default="brainwave", help='MQTT topic prefix: band powers go to <topic>[/<board>]/bands and events to <topic>/events')
+    parser.add_argument('--mqtt_qos', type=int, choices=[0, 1, 2], default=0, help='MQTT quality of service')
+    parser.add_argument('--mqtt_epochs_per_message', type=int, default=1, help='Epochs of band powers batched into each MQTT message')
+    parser.add_argument('--mqtt_complexity', nargs='+', choices=COMPLEXITY_COLUMNS, default=[], help='Complexity metrics to publish to MQTT alongside the band powers')
+    parser.add_argument('--mqtt_max_queue', type=int, default=1000, help='MQTT messages held while disconnected, beyond which the oldest are dropped')
     parser.add_argument('--influx_url', type=str, help='InfluxDB URL')
     parser.add_argument('--influx_database', type=str, help='InfluxDB database')
     parser.add_argument('--influx_username', type=str, help='InfluxDB username')
     parser.add_argument('--influx_password', type=str, help='InfluxDB password')
+    parser.add_argument('--websocket_queue_size', type=int, default=16, help='Messages queued per websocket client before the oldest are dropped')
+    parser.add_argument('--influx_raw', action='store_true', help='Also write every raw sample to InfluxDB')
+    parser.add_argument('--influx_batch_size', type=int, default=5000, help='Lines per InfluxDB write')
+    parser.add_argument('--influx_flush_interval', type=float, default=1.0, help='Seconds between InfluxDB writes')
+    parser.add_argument('--influx_spool_file', type=str, help='File to spool InfluxDB lines to if the in-memory retry spool fills up')
+    parser.add_argument('--feature_store', type=str, help='Append per-epoch features to a local columnar feature store in this directory')
     parser.add_argument('--ssl_cert', type=str, help='SSL cert file for websocket server')
     parser.add_argument('--ssl_key', type=str, help='SSL key file for websocket server')
     parser.add_argument('--streamer', type=str, help='Will add a Brainflow streamer output, e.g. streaming_board://224.0.0.0:10000, that can then be read by programs like OpenBCI GUI')
-    #parser.add_argument('--lsl', type=boolean, help='Will add an LSL streamer output with name "Brainwave-LSL" and type "EEG", and the provided identifier')
+    parser.add_argument('--lsl', type=str, help='Will add an LSL streamer output with name "brainwave-lsl" and type "EEG", and the provided identifier')
+    parser.add_argument('--lsl_filtered', action='store_true', help='Also stream the filtered data over LSL, as "brainwave-lsl-filtered"')
+    parser.add_argument('--shared_memory', type=str, help='Publish raw and filtered samples and per-epoch features to shared memory with this name, for local processes to read with shm_ring.SharedRingReader')
+    parser.add_argument('--shared_memory_seconds', type=float, default=60, help='Seconds of samples kept in shared memory')
+    parser.add_argument('--metrics_port', type=int, help='Serve per-stage latency metrics in Prometheus text format on this port')
+    parser.add_argument('--metrics_interval', type=float, default=5, help='Seconds between "metrics" websocket messages')
 
     args = parser.parse_args()
 
+    specs = args.board
+    if not specs:
+        if args.board_id is None or not args.channels:
+            parser.error("Either --board_id and --channels, or --board, are required")
+        specs = [BoardSpec(f"{args.board_id}:{','.join(args.channels)}:{args.serial_port or ''}")]
+    elif len(specs) > 1:
+        # Names tag each board's outputs, so are needed when there are several
+        for index, spec in enumerate(specs):
+            if spec.name is None:
+                spec.name = f"board{index}"
+        if len({spec.name for spec in specs}) < len(specs):
+            parser.error("Board names must be unique")
+
     logger.info(f"Starting Brainflow with args: {args}")
 
     done = False
     samples_per_epoch = args.samples_per_epoch
+    # Board name (None for a single unnamed board) -> BrainflowInput
+    boards: dict[Optional[str], BrainflowInput] = {}
 
-    def emit_event_callback(event_name: str, timestamp: float):
-        logger.info(f"Emitting event: {event_name} for {timestamp}")
-        message = json.dumps({
+    def emit_event_callback(event_name: str, timestamp: float, board: Optional[str] = None):
+        logger.info(f"Emitting event: {event_name} for {timestamp}" + ("" if board is None else f" from {board}"))
+        message = {
             'address': 'brainflow_event',
             'event': event_name,
             'timestamp': timestamp
-        })
-        asyncio.create_task(websocket_handler.broadcast_websocket_message(message))
+        }
+        if board is not None:
+            message['board'] = board
+        asyncio.create_task(websocket_handler.broadcast_websocket_message(json.dumps(message), 'brainflow_event'))
+        if mqtt:
+            mqtt.write_event(event_name, timestamp, board)
+
+    def on_late_complexity(epoch_index: int, results: list[dict], board: Optional[str]):
+        channel_names = boards[board].channel_names
+        message = {
+            'address': 'complexity',
+            'epoch': epoch_index,
+            'data': [{'channelIdx': index, 'channelName': channel_names[index], 'complexity': complexity}
+                     for index, complexity in enumerate(results) if complexity]
+        }
+        if board is not None:
+            message['board'] = board
+        asyncio.create_task(websocket_handler.broadcast_websocket_message(json.dumps(message, cls=CustomEncoder), 'complexity'))
+
+    def on_sleep(summary: dict, board: Optional[str]):
+        message = {'address': 'sleep', **summary}
+        if board is not None:
+            message['board'] = board
+        asyncio.create_task(websocket_handler.broadcast_websocket_message(json.dumps(message), 'sleep'))
+        if influx:
+            influx.write_sleep_to_influx(summary, board)
+
+    metrics = Metrics()
+    enabled_features = [feature for feature in args.features if feature not in args.disable_features]
+    # Per board, as timings and overrun degradation are per board
+    features = {spec.name: FeatureRegistry(enabled_features) for spec in specs}
+
+    def on_features(enable: list[str], disable: list[str]) -> dict:
+        for registry in features.values():
+            registry.enable(enable)
+            registry.disable(disable)
+        if len(features) == 1:
+            return next(iter(features.values())).status()
+        return {'boards': {name: registry.status() for name, registry in features.items()}}
+
+    def selected_boards(board: Optional[str]) -> list[BrainflowInput]:
+        if board is None:
+            return list(boards.values())
+        if board not in boards:
+            raise ValueError(f"Unknown board {board}, available are {list(boards.keys())}")
+        return [boards[board]]
+
+    def on_start(channel_names: Optional[list[str]], board: Optional[str] = None):
+        for brainflow_input in selected_boards(board):
+            brainflow_input.connect_to_board(channel_names)
+
+    def on_stop(board: Optional[str] = None):
+        for brainflow_input in selected_boards(board):
+            brainflow_input.close()
+
+    # One pool for every board
+    complexity_pool = ComplexityPool(args.complexity_workers, args.complexity_deadline_ms, on_late_complexity, metrics)
+    complexity_metrics = sorted({name for registry in features.values() for name in registry.enabled_complexity_metrics()})
+    if not args.just_wait and complexity_metrics:
+        complexity_pool.warm_up(complexity_metrics)
 
     influx = None
     if args.influx_url:
         if not all([args.influx_url, args.influx_database, args.influx_username, args.influx_password]):
             logger.error("All InfluxDB parameters (URL, token, org, bucket) must be provided")
             return
-        influx = InfluxWriter(args.influx_url, args.influx_database, args.influx_username, args.influx_password)
-    brainflow_input = BrainflowInput(args.board_id, args.channels, args.serial_port, samples_per_epoch, args.streamer, args.output_dir, emit_event_callback)
+        # Imported here so influxdb is only needed when writing to it
+        from influx import InfluxWriter
+        influx = InfluxWriter(args.influx_url, args.influx_database, args.influx_username, args.influx_password,
+                              args.influx_batch_size, args.influx_flush_interval, spool_file=args.influx_spool_file,
+                              metrics=metrics)
+
+    mqtt = None
+    if args.mqtt_url:
+        # Imported here so paho-mqtt is only needed when publishing to MQTT
+        from mqtt import MqttWriter
+        mqtt = MqttWriter(args.mqtt_url, args.mqtt_username, args.mqtt_password, args.mqtt_topic, args.mqtt_qos,
+                          args.mqtt_epochs_per_message, args.mqtt_complexity, args.mqtt_max_queue, metrics=metrics)
 
-    lsl = None
-    #if args.lsl:
-    #    lsl = LslWriter("cyton", args.channels, brainflow_input.sampling_rate)
+    sleep_executor = None
+    if args.sleep and (args.sleep_staging_channel or args.sleep_detect):
+        # yasa is slow, and only needed every window, so it gets a worker of its own rather than sharing complexity's
+        from concurrent.futures import ProcessPoolExecutor
+        sleep_executor = ProcessPoolExecutor(max_workers=1)
+        warm_up_sleep(sleep_executor)
+
+    if args.streamer and len(specs) > 1:
+        logger.warning("--streamer is only used with a single board")
+    feature_stores = {}
+    lsls = {}
+    sleep_analysers = {}
+    for spec in specs:
+        boards[spec.name] = BrainflowInput(spec.board_id, spec.channels, spec.serial_port, samples_per_epoch,
+                                           args.streamer if len(specs) == 1 else None, args.output_dir,
+                                           emit_event_callback, complexity_pool, features[spec.name],
+                                           args.max_backlog_seconds, args.hop_samples, args.welch_segment_samples,
+                                           args.welch_overlap_samples, not args.just_wait, args.overrun_policy,
+                                           args.overrun_threshold_seconds, metrics, name=spec.name,
+                                           artifact_threshold=args.artifact_threshold,
+                                           artifact_min_channels=args.artifact_min_channels,
+                                           shared_memory_name=args.shared_memory if args.shared_memory is None or spec.name is None else f"{args.shared_memory}-{spec.name}",
+                                           shared_memory_seconds=args.shared_memory_seconds)
+        if args.feature_store:
+            feature_stores[spec.name] = FeatureStoreWriter(args.feature_store if spec.name is None else os.path.join(args.feature_store, spec.name))
+        if args.sleep:
+            sleep_analysers[spec.name] = SleepAnalyser(boards[spec.name].sampling_rate, spec.channels, on_sleep,
+                                                       sleep_executor, args.sleep_window_seconds,
+                                                       args.sleep_history_minutes, args.sleep_staging_channel,
+                                                       args.sleep_detect, spec.name)
+        if args.lsl:
+            # Imported here so pylsl is only needed when LSL output is wanted
+            from lsl import LslWriter
+            suffix = "" if spec.name is None else "-" + spec.name
+            lsls[spec.name] = LslWriter(args.lsl + suffix, spec.channels, boards[spec.name].sampling_rate,
+                                        args.lsl_filtered, metrics, "brainwave-lsl" + suffix)
 
     def set_done_true():
         nonlocal done
         done = True
 
     websocket_handler = WebsocketHandler(args.ssl_cert, args.ssl_key,
-                                         brainflow_input.connect_to_board,
-                                         lambda: brainflow_input.close(),
+                                         on_start,
+                                         on_stop,
                                          set_done_true,
-                                         emit_event_callback)
+                                         emit_event_callback,
+                                         on_features,
+                                         args.websocket_queue_size,
+                                         metrics)
 
     websocket_server_task = None
     if args.websocket_port:
         logger.info("Starting websocket server")
         websocket_server_task = asyncio.create_task(websocket_handler.start_websocket_server(args.websocket_port))
 
+    async def publish_metrics():
+        while True:
+            await asyncio.sleep(args.metrics_interval)
+            websocket_handler.update_metrics()
+            complexity_pool.update_metrics()
+            if influx:
+                influx.update_metrics()
+            if mqtt:
+                mqtt.update_metrics()
+            message = json.dumps({'address': 'metrics', **metrics.snapshot()})
+            await websocket_handler.broadcast_websocket_message(message, 'metrics')
+
+    metrics_task = asyncio.create_task(publish_metrics())
+    metrics_server_task = None
+    if args.metrics_port:
+        metrics_server_task = asyncio.create_task(metrics.start_http_server(args.metrics_port))
+
+    report = startup_report(STARTED)
+    metrics.set_gauge("startup_seconds", report['seconds'])
+    if report['peakRssBytes'] is not None:
+        metrics.set_gauge("startup_peak_rss_bytes", report['peakRssBytes'])
+    rss = "unknown" if report['peakRssBytes'] is None else f"{report['peakRssBytes'] / 1e6:.0f} MB"
+    logger.info(f"Started in {report['seconds']:.2f}s, peak RSS {rss}, {report['modules']} modules loaded (heavy: {', '.join(report['heavyModules']) or 'none'})")
+
     logger.info('WaitForCommands: ' + str(args.wait_for_commands))
 
     if args.wait_for_commands == False:
         logger.info("Connect")
-        brainflow_input.connect_to_board(None)
+        # So the first epochs aren't held up by it, with samples piling up meanwhile
+        await complexity_pool.wait_until_warm()
+        for brainflow_input in boards.values():
+            brainflow_input.connect_to_board(None)
+
+    async def run_board(board: Optional[str], brainflow_input: BrainflowInput):
+        # Each board gets its own loop, so one board's slow epoch doesn't hold up the others'
+        feature_store = feature_stores.get(board)
+        lsl = lsls.get(board)
+        sleep = sleep_analysers.get(board)
+        while not done:
+            if args.just_wait == True:
+                await asyncio.sleep(10 / 1000)
+                continue
+
+            try:
+                # Woken by the acquisition thread once the next epoch's samples are in, with a timeout so 'done' is
+                # still checked while there's no board connected
+                if not await brainflow_input.wait_for_epoch(0.5):
+                    continue
+
+                result = await brainflow_input.fetch_and_process_samples()
+
+                if result is not None:
+                    start_of_epoch = datetime.now().timestamp() * 1000
 
-    while not done:
-        if args.just_wait == True:
-            await asyncio.sleep(10 / 1000)
-            continue
+                    _ = asyncio.create_task(websocket_handler.broadcast_eeg(result, brainflow_input.epoch_index, board))
 
-        try:
-            await asyncio.sleep(samples_per_epoch / 1000)
+                    if influx:
+                        # Only queues the points, they are written from a background thread
+                        influx.write_to_influx(result, start_of_epoch, samples_per_epoch, brainflow_input.sampling_rate, board)
+                        if args.influx_raw:
+                            influx.write_raw_to_influx(brainflow_input.last_raw, brainflow_input.last_timestamps, brainflow_input.channel_names, board)
 
-            eeg_data = await brainflow_input.fetch_and_process_samples()
+                    if feature_store:
+                        # Timestamped by the board, at the first sample of the epoch
+                        feature_store.append(brainflow_input.epoch_index, float(brainflow_input.last_timestamps[0]), result)
 
-            if len(eeg_data) > 0:
-                start_of_epoch = datetime.now().timestamp() * 1000
+                    if mqtt:
+                        mqtt.write_epoch(result, brainflow_input.epoch_index, float(brainflow_input.last_timestamps[0]), board)
 
-                _ = asyncio.create_task(websocket_handler.broadcast_websocket_message(json.dumps({
-                    'address': 'eeg',
-                    'data': [channel.__dict__ for channel in eeg_data]
-                }, cls=CustomEncoder)))
+                    if sleep:
+                        sleep.add_epoch(result, brainflow_input.last_raw, brainflow_input.last_timestamps)
 
-                if influx:
-                    _ = asyncio.create_task(influx.write_to_influx(eeg_data, start_of_epoch, samples_per_epoch, brainflow_input.sampling_rate))
-                    # _ = asyncio.create_task(influx.write_raw_to_influx(eeg_data, start_of_epoch, samples_per_epoch, brainflow_input.sampling_rate))
+                    if lsl:
+                        lsl.write_to_lsl(brainflow_input.last_raw, brainflow_input.last_filtered, brainflow_input.last_timestamps)
 
-                if lsl:
-                    _ = asyncio.create_task(lsl.write_to_lsl(eeg_data, start_of_epoch, samples_per_epoch, brainflow_input.sampling_rate))
+            except Exception as e:
+                logger.error(f"Error: {e}")
+                traceback.print_exc()
+                pass
 
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            traceback.print_exc()
-            pass
+    await asyncio.gather(*(run_board(board, brainflow_input) for board, brainflow_input in boards.items()))
 
+    # Stopped first, as exit can be held up by worker processes finishing, and the acquisition threads would keep
+    # polling against a closed event loop meanwhile
+    for brainflow_input in boards.values():
+        brainflow_input.close()
+        brainflow_input.close_shared_memory()
+    metrics_task.cancel()
+    if metrics_server_task:
+        metrics_server_task.cancel()
+    complexity_pool.close()
+    if sleep_executor:
+        sleep_executor.shutdown(wait=False, cancel_futures=True)
+    if influx:
+        influx.close()
+    if mqtt:
+        mqtt.close()
+    for feature_store in feature_stores.values():
+        feature_store.close()
     logger.info('Done')
 
 
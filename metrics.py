@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+# Worth knowing about if they've been loaded, for the startup report
+HEAVY_MODULES = ["antropy", "numba", "sklearn", "scipy.signal", "mne", "pandas", "yasa", "influxdb", "pylsl", "paho.mqtt"]
+
+
+def peak_rss_bytes() -> Optional[int]:
+    # Peak resident memory of this process, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def startup_report(started: float) -> dict:
+    # started is a time.perf_counter() taken as early as possible in the process
+    rss = peak_rss_bytes()
+    return {
+        'seconds': time.perf_counter() - started,
+        'peakRssBytes': rss,
+        'modules': len(sys.modules),
+        'heavyModules': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+class RollingHistogram:
+    # The last `size` observations of a stage, in seconds, plus running totals
+    def __init__(self, size: int):
+        self.values = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> dict:
+        values = np.fromiter(self.values, dtype=np.float64, count=len(self.values))
+        quantiles = np.quantile(values, QUANTILES) if len(values) else [0.0] * len(QUANTILES)
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'p50': float(quantiles[0]),
+            'p95': float(quantiles[1]),
+            'p99': float(quantiles[2]),
+            'max': float(values.max()) if len(values) else 0.0,
+        }
+
+
+def gauge_key(item) -> tuple:
+    (name, board), _ = item
+    return name, "" if board is None else board
+
+
+def board_gauges(gauges: dict) -> dict:
+    grouped = {}
+    for (name, board), value in sorted(gauges.items(), key=gauge_key):
+        if board is not None:
+            grouped.setdefault(name, {})[board] = value
+    return grouped
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    # Per-stage latency histograms and a few gauges.  Stages are observed from the event loop and from the
+    # acquisition and Influx threads, hence the lock.
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.histograms: dict[str, RollingHistogram] = {}
+        # (name, board) -> value, board being None for those that aren't per board
+        self.gauges: dict[tuple[str, Optional[str]], float] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = RollingHistogram(self.window)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def set_gauge(self, name: str, value: float, board: Optional[str] = None):
+        with self.lock:
+            self.gauges[(name, board)] = value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'stages': {stage: histogram.snapshot() for stage, histogram in sorted(self.histograms.items())},
+                'gauges': {name: value for (name, board), value in sorted(self.gauges.items(), key=gauge_key) if board is None},
+                # name -> board -> value
+                'boardGauges': board_gauges(self.gauges),
+            }
+
+    def prometheus_text(self) -> str:
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP brainwave_stage_seconds Time spent in each pipeline stage",
+            "# TYPE brainwave_stage_seconds summary",
+        ]
+        for stage, stats in snapshot['stages'].items():
+            for quantile, key in zip(QUANTILES, ('p50', 'p95', 'p99')):
+                lines.append(f'brainwave_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'brainwave_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+            lines.append(f'brainwave_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for name, value in snapshot['gauges'].items():
+            lines.append(f"# TYPE brainwave_{name} gauge")
+            lines.append(f"brainwave_{name} {value}")
+        # Boards are labels, as their names needn't be valid in metric names
+        for name, values in snapshot['boardGauges'].items():
+            lines.append(f"# TYPE brainwave_{name} gauge")
+            for board, value in values.items():
+                lines.append(f'brainwave_{name}{{board="{escape_label(board)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # Skip the headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request_line) >= 2 and request_line[0] == 'GET' and request_line[1] in ('/', '/metrics'):
+                status, body = "200 OK", self.prometheus_text().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    async def start_http_server(self, port: int):
+        # Plain-text Prometheus-style endpoint at /metrics
+        logger.info(f"Metrics HTTP server starting on port {port}")
+        server = await asyncio.start_server(self.handle_http, "", port)
+        async with server:
+            await server.serve_forever()
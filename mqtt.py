@@ -1,20 +1,163 @@
-if args.mqtt_url:
-    mqtt_client = mqtt.Client()
-    if args.mqtt_username and args.mqtt_password:
-        mqtt_client.username_pw_set(args.mqtt_username, args.mqtt_password)
-    mqtt_client.connect(args.mqtt_url)
-    mqtt_client.loop_start()
-    logger.info(f"Connected to MQTT on {args.mqtt_url}")
-
-    # if mqtt_client:
-    #     mqtt_client.publish('brainwave/eeg', json.dumps([
-    #         {
-    #             'channel': channel.channel_name,
-    #             'delta': channel.band_powers.delta,
-    #             'theta': channel.band_powers.theta,
-    #             'alpha': channel.band_powers.alpha,
-    #             'beta': channel.band_powers.beta,
-    #             'gamma': channel.band_powers.gamma
-    #         } for channel in eeg_data
-    #     ]))
+from __future__ import annotations
 
+import json
+import logging
+import math
+import threading
+from collections import deque
+from typing import Optional
+from urllib.parse import urlsplit
+
+import paho.mqtt.client as paho
+
+from metrics import Metrics
+from shared import EpochResult, BAND_NAMES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 1883
+
+
+def parse_url(url: str) -> tuple[str, int]:
+    # Accepts host, host:port or mqtt://host:port
+    parsed = urlsplit(url if "://" in url else "mqtt://" + url)
+    return parsed.hostname, parsed.port or DEFAULT_PORT
+
+
+def significant(value: Optional[float], digits: int) -> Optional[float]:
+    # Consumers don't need 17 digits, and they make up most of the payload.  NaN and inf (e.g. entropy of a flat
+    # channel) aren't valid JSON, so are null.
+    if value is None or not math.isfinite(value):
+        return None
+    return float(f"{value:.{digits}g}")
+
+
+class MqttWriter:
+    # Publishes low-rate summaries for consumers that can't take the full websocket feed, e.g. home automation:
+    #   <topic>[/<board>]/bands   band powers and the chosen complexity metrics, every epochs_per_message epochs:
+    #                             {"channels": [...], "bands": [...], "complexity": [...], "epochs": [{"epoch", "timestamp",
+    #                             "bandPowers": [[per band] per channel], "complexity": [[per metric] per channel]}, ...]}
+    #   <topic>/events            each brainflow_event, as it happens: {"event", "timestamp"}, plus "board" if named
+    # paho's network thread connects and reconnects in the background.  While disconnected, messages are held in a
+    # queue of at most max_queued_messages, dropping the oldest, and sent on reconnection.
+    def __init__(self, url: str, username: Optional[str] = None, password: Optional[str] = None,
+                 topic: str = "brainwave", qos: int = 0, epochs_per_message: int = 1,
+                 complexity_metrics: Optional[list[str]] = None, max_queued_messages: int = 1000,
+                 significant_digits: int = 5, metrics: Optional[Metrics] = None):
+        self.topic = topic.rstrip("/")
+        self.qos = qos
+        self.epochs_per_message = max(1, epochs_per_message)
+        self.complexity_metrics = complexity_metrics or []
+        self.significant_digits = significant_digits
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Board name -> epochs waiting to be batched into a message
+        self.pending: dict[Optional[str], list[dict]] = {}
+        self.channel_names: dict[Optional[str], list[str]] = {}
+        self.queue: deque[tuple[str, bytes]] = deque()
+        self.max_queued_messages = max_queued_messages
+        self.dropped_messages = 0
+        self.connected = False
+        self.lock = threading.Lock()
+
+        self.client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+        if username and password:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        host, port = parse_url(url)
+        # Asynchronous, so a broker that's down doesn't hold up startup
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+        logger.info(f"Publishing to MQTT on {host}:{port} under {self.topic} with QoS {qos}")
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error(f"MQTT connection refused: {reason_code}")
+            return
+        logger.info("Connected to MQTT")
+        with self.lock:
+            self.connected = True
+            queued = list(self.queue)
+            self.queue.clear()
+        if queued:
+            logger.info(f"Sending {len(queued)} MQTT messages queued while disconnected")
+        for topic, payload in queued:
+            self.publish(topic, payload)
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        with self.lock:
+            self.connected = False
+        logger.warning(f"Disconnected from MQTT: {reason_code}")
+
+    def board_topic(self, board: Optional[str], name: str) -> str:
+        return f"{self.topic}/{name}" if board is None else f"{self.topic}/{board}/{name}"
+
+    def write_epoch(self, result: EpochResult, epoch_index: int, timestamp: float, board: Optional[str] = None):
+        digits = self.significant_digits
+        epoch = {'epoch': epoch_index, 'timestamp': timestamp}
+        if result.band_powers is not None:
+            epoch['bandPowers'] = [[significant(value, digits) for value in row] for row in result.band_powers.tolist()]
+        if self.complexity_metrics:
+            epoch['complexity'] = [[significant(complexity.get(name), digits) for name in self.complexity_metrics]
+                                   for complexity in result.complexity]
+        self.channel_names[board] = result.channel_names
+        pending = self.pending.setdefault(board, [])
+        pending.append(epoch)
+        if len(pending) >= self.epochs_per_message:
+            self.flush_board(board)
+
+    def flush_board(self, board: Optional[str]):
+        epochs = self.pending.pop(board, [])
+        if not epochs:
+            return
+        message = {'channels': self.channel_names[board], 'bands': BAND_NAMES, 'complexity': self.complexity_metrics,
+                   'epochs': epochs}
+        self.send(self.board_topic(board, "bands"), message)
+
+    def write_event(self, event_name: str, timestamp: float, board: Optional[str] = None):
+        message = {'event': event_name, 'timestamp': timestamp}
+        if board is not None:
+            message['board'] = board
+        self.send(f"{self.topic}/events", message)
+
+    def send(self, topic: str, message: dict):
+        # Raises rather than sending NaN, which consumers would fail to parse
+        payload = json.dumps(message, separators=(',', ':'), allow_nan=False).encode('utf-8')
+        with self.lock:
+            if not self.connected:
+                self.enqueue(topic, payload)
+                return
+        self.publish(topic, payload)
+
+    def enqueue(self, topic: str, payload: bytes):
+        # With the lock held
+        if len(self.queue) >= self.max_queued_messages:
+            self.queue.popleft()
+            self.dropped_messages += 1
+        self.queue.append((topic, payload))
+
+    def publish(self, topic: str, payload: bytes):
+        with self.metrics.time("mqtt_publish"):
+            info = self.client.publish(topic, payload, qos=self.qos)
+        if info.rc != paho.MQTT_ERR_SUCCESS:
+            # Lost the connection since checking.  paho keeps QoS 1 and 2 messages itself for the reconnection, QoS 0
+            # ones are kept here.
+            with self.lock:
+                self.connected = False
+                if self.qos == 0:
+                    self.enqueue(topic, payload)
+
+    def update_metrics(self):
+        with self.lock:
+            self.metrics.set_gauge("mqtt_connected", int(self.connected))
+            self.metrics.set_gauge("mqtt_queued", len(self.queue))
+            self.metrics.set_gauge("mqtt_dropped", self.dropped_messages)
+
+    def close(self):
+        for board in list(self.pending):
+            self.flush_board(board)
+        # Disconnecting first lets the network thread send what's outstanding
+        self.client.disconnect()
+        self.client.loop_stop()
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from brainflow import BoardShim
+from brainflow.data_filter import DataFilter
+from nptyping import NDArray, Float64
+
+from complexity import ComplexityPool
+from feature_store import FeatureStoreWriter, epoch_rows, COLUMNS
+from features import FeatureRegistry, ALL_FEATURES, FFT_RAW, FFT_FILTERED
+from filters import StreamingFilterBank
+from processing import EpochProcessor
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# The spectra aren't written out, so aren't worth computing by default
+DEFAULT_FEATURES = [feature for feature in ALL_FEATURES if feature not in (FFT_RAW, FFT_FILTERED)]
+
+
+def load_recording(filename: str, board_id: int, num_channels: int, cache_dir: str) -> str:
+    # Parsing the CSV is slow, so the EEG channels plus the timestamp row (last) are cached as .npy next to the
+    # output.  Workers memory-map that and read just their chunk, rather than having it pickled over to them.  Keyed
+    # by board too, as that decides which rows are the EEG channels.
+    cached = os.path.join(cache_dir, os.path.basename(filename) + f".board{board_id}.{num_channels}ch.npy")
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(filename):
+        logger.info(f"Using cached {cached}")
+        return cached
+    logger.info(f"Reading {filename}")
+    data = DataFilter.read_file(filename)
+    rows = BoardShim.get_eeg_channels(board_id)[:num_channels] + [BoardShim.get_timestamp_channel(board_id)]
+    np.save(cached, np.ascontiguousarray(data[rows]))
+    return cached
+
+
+class Chunk:
+    # A run of consecutive epochs from one recording, processed by one worker
+    def __init__(self, npy_file: str, first_epoch: int, num_epochs: int, samples_per_epoch: int, hop_samples: int,
+                 warmup_samples: int, sampling_rate: int, channel_names: list[str], features: list[str],
+                 welch_segment_samples: Optional[int], welch_overlap_samples: int, artifact_threshold: float):
+        self.npy_file = npy_file
+        self.first_epoch = first_epoch
+        self.num_epochs = num_epochs
+        self.samples_per_epoch = samples_per_epoch
+        self.hop_samples = hop_samples
+        self.warmup_samples = warmup_samples
+        self.sampling_rate = sampling_rate
+        self.channel_names = channel_names
+        self.features = features
+        self.welch_segment_samples = welch_segment_samples
+        self.welch_overlap_samples = welch_overlap_samples
+        self.artifact_threshold = artifact_threshold
+
+
+async def process_epochs(chunk: Chunk, eeg: NDArray[Float64], filtered: NDArray[Float64],
+                         timestamps: NDArray[Float64], offset: int) -> list[dict]:
+    features = FeatureRegistry(chunk.features)
+    processor = EpochProcessor(chunk.sampling_rate, chunk.channel_names, ComplexityPool(0, 0), features,
+                               chunk.welch_segment_samples, chunk.welch_overlap_samples,
+                               artifact_threshold=chunk.artifact_threshold)
+    rows = []
+    for epoch in range(chunk.first_epoch, chunk.first_epoch + chunk.num_epochs):
+        start = epoch * chunk.hop_samples
+        local = slice(start - offset, start - offset + chunk.samples_per_epoch)
+        # Same numbering as live, starting from 1
+        result = await processor.process(epoch + 1, eeg[:, local], filtered[:, local], start)
+        rows.extend(epoch_rows(epoch + 1, float(timestamps[local.start]), result))
+    return rows
+
+
+def process_chunk(chunk: Chunk) -> list[dict]:
+    # Runs in a worker process.  The filters start warmup_samples before the chunk so their state has settled by its
+    # first epoch, closely matching the continuous filtering done live.
+    data = np.load(chunk.npy_file, mmap_mode='r')
+    first_sample = chunk.first_epoch * chunk.hop_samples
+    end = (chunk.first_epoch + chunk.num_epochs - 1) * chunk.hop_samples + chunk.samples_per_epoch
+    offset = max(0, first_sample - chunk.warmup_samples)
+    eeg = np.array(data[:-1, offset:end])
+    filtered = StreamingFilterBank(chunk.sampling_rate, eeg.shape[0]).process(eeg)
+    return asyncio.run(process_epochs(chunk, eeg, filtered, data[-1, offset:end], offset))
+
+
+def write_rows(writer: Optional[csv.DictWriter], f, rows: list[dict]) -> Optional[csv.DictWriter]:
+    if not rows:
+        return writer
+    if writer is None:
+        # The feature store's fixed schema, rather than whatever the first rows happened to have, as a metric that
+        # failed or missed its deadline there would lose its column for the whole file
+        writer = csv.DictWriter(f, fieldnames=[name for name, _ in COLUMNS], restval='', extrasaction='ignore')
+        writer.writeheader()
+    writer.writerows(rows)
+    return writer
+
+
+def run_offline():
+    parser = argparse.ArgumentParser(description="Reprocesses recorded .brainflow.csv files, faster than real time")
+    parser.add_argument('files', nargs='+', help='Recorded .brainflow.csv files')
+    parser.add_argument('-b', '--board_id', type=int, required=True, help='The Brainflow board ID the files were recorded with')
+    parser.add_argument('-c', '--channels', nargs='+', required=True, help='Specify channel names')
+    parser.add_argument('-spe', '--samples_per_epoch', type=int, default=250, help='Samples per epoch')
+    parser.add_argument('--hop_samples', type=int, help='Sliding window mode: an epoch of samples_per_epoch samples every this many samples')
+    parser.add_argument('--welch_segment_samples', type=int, help='Welch segment length for PSDs, defaults to the whole epoch (capped at 2048)')
+    parser.add_argument('--welch_overlap_samples', type=int, default=0, help='Welch segment overlap')
+    parser.add_argument('--artifact_threshold', type=float, default=30, help='Filtered amplitude (uV) above which samples count towards over_threshold')
+    parser.add_argument('--features', nargs='+', choices=ALL_FEATURES, default=DEFAULT_FEATURES, help='Per-epoch features to compute')
+    parser.add_argument('--disable_features', nargs='+', choices=ALL_FEATURES, default=[], help='Per-epoch features to skip')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+    parser.add_argument('--chunk_epochs', type=int, default=600, help='Epochs per unit of work handed to a worker')
+    parser.add_argument('--warmup_seconds', type=float, default=10, help='Data filtered before each chunk and discarded, so the filters have settled')
+    parser.add_argument('-o', '--output_dir', type=str, default=".", help="Where to write the features (and cached data)")
+    parser.add_argument('--feature_store', type=str, help='Also append the features to the columnar feature store in this directory.  Files should be given in time order.')
+    parser.add_argument('--no_csv', action='store_true', help="Don't write the .features.csv files")
+
+    args = parser.parse_args()
+
+    logger.info(f"Starting offline processing with args: {args}")
+
+    sampling_rate = BoardShim.get_sampling_rate(args.board_id)
+    samples_per_epoch = args.samples_per_epoch
+    hop_samples = samples_per_epoch if args.hop_samples is None else args.hop_samples
+    if not 0 < hop_samples <= samples_per_epoch:
+        raise ValueError(f"hop_samples must be between 1 and samples_per_epoch ({samples_per_epoch}), got {hop_samples}")
+    features = [feature for feature in args.features if feature not in args.disable_features]
+    warmup_samples = int(args.warmup_seconds * sampling_rate)
+    os.makedirs(args.output_dir, exist_ok=True)
+    feature_store = FeatureStoreWriter(args.feature_store) if args.feature_store else None
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for filename in args.files:
+            start_time = time.perf_counter()
+            npy_file = load_recording(filename, args.board_id, len(args.channels), args.output_dir)
+            num_samples = np.load(npy_file, mmap_mode='r').shape[1]
+            num_epochs = 0 if num_samples < samples_per_epoch else (num_samples - samples_per_epoch) // hop_samples + 1
+            chunks = [Chunk(npy_file, first_epoch, min(args.chunk_epochs, num_epochs - first_epoch), samples_per_epoch,
+                            hop_samples, warmup_samples, sampling_rate, args.channels, features,
+                            args.welch_segment_samples, args.welch_overlap_samples, args.artifact_threshold)
+                      for first_epoch in range(0, num_epochs, args.chunk_epochs)]
+            logger.info(f"Processing {num_epochs} epochs from {filename} in {len(chunks)} chunks")
+
+            output = os.path.join(args.output_dir, os.path.basename(filename).removesuffix(".csv").removesuffix(".brainflow") + ".features.csv")
+            with open(output if not args.no_csv else os.devnull, 'w', newline='') as f:
+                writer = None
+                # map yields in order, so the output is too
+                for rows in executor.map(process_chunk, chunks):
+                    writer = write_rows(writer, f, rows)
+                    if feature_store:
+                        feature_store.append_rows(rows)
+
+            elapsed = time.perf_counter() - start_time
+            recorded = num_samples / sampling_rate
+            logger.info(f"Processed {filename}: {recorded:.0f}s of data in {elapsed:.1f}s ({recorded / elapsed:.0f}x real time)")
+
+    if feature_store:
+        feature_store.close()
+
+
+if __name__ == "__main__":
+    run_offline()
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import logging
+
+import numpy as np
+
+from nptyping import NDArray, Float64
+from typing import List, Optional
+
+from artifacts import ArtifactDetector
+from complexity import ComplexityPool
+from features import FeatureRegistry, BAND_POWERS, FFT_RAW, FFT_FILTERED, THRESHOLD, PSD, COMPLEXITY
+from shared import EpochResult, BAND_DEFINITIONS
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def linear_detrend(data: NDArray[Float64]) -> NDArray[Float64]:
+    # Least-squares linear detrend along the last axis, for all rows at once
+    n = data.shape[-1]
+    t = np.arange(n, dtype=np.float64) - (n - 1) / 2
+    denominator = np.dot(t, t)
+    centred = data - data.mean(axis=-1, keepdims=True)
+    if denominator == 0:
+        return centred
+    slope = centred @ t / denominator
+    return centred - slope[..., np.newaxis] * t
+
+
+class WelchPsd:
+    # Batched Welch PSD.  The defaults match MNE's Raw.compute_psd (Hamming window, n_fft capped at 2048, no overlap,
+    # constant detrend per segment, density scaling).  Window, scaling and frequency grid are computed once per
+    # epoch length and reused.
+    # When windows overlap (sliding window mode) the per-segment spectra are cached by their absolute position in the
+    # stream, so each new window only needs the FFTs of segments it hasn't seen before.
+    def __init__(self, sampling_rate: int, n_samples: int, n_per_seg: Optional[int] = None, n_overlap: int = 0,
+                 fmax: float = 120, n_fft: int = 2048):
+        self.sampling_rate = sampling_rate
+        self.n_samples = n_samples
+        self.n_per_seg = min(n_fft if n_per_seg is None else n_per_seg, n_samples)
+        if not 0 <= n_overlap < self.n_per_seg:
+            raise ValueError(f"Welch overlap {n_overlap} must be less than the segment length {self.n_per_seg}")
+        self.step = self.n_per_seg - n_overlap
+        self.segment_offsets = list(range(0, n_samples - self.n_per_seg + 1, self.step))
+        self.window = np.hamming(self.n_per_seg + 1)[:-1] if self.n_per_seg > 1 else np.ones(1)
+        scale = 1.0 / (sampling_rate * np.sum(self.window ** 2))
+        all_freqs = np.fft.rfftfreq(self.n_per_seg, 1.0 / sampling_rate)
+        # One-sided spectrum: double everything except DC and (for even lengths) Nyquist
+        self.scale = np.full(len(all_freqs), 2 * scale)
+        self.scale[0] = scale
+        if self.n_per_seg % 2 == 0:
+            self.scale[-1] = scale
+        self.freq_slice = slice(0, int(np.searchsorted(all_freqs, fmax, side='right')))
+        self.freqs = all_freqs[self.freq_slice]
+        # (kind, absolute segment start) -> (channels x freqs)
+        self.segment_cache: dict[tuple[str, int], NDArray[Float64]] = {}
+
+    def _spectra(self, segments: NDArray[Float64], linear: NDArray) -> NDArray[Float64]:
+        # segments is (n, channels, n_per_seg), linear is a bool per segment selecting linear rather than constant detrend
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        if linear.any():
+            segments[linear] = linear_detrend(segments[linear])
+        spectrum = np.fft.rfft(segments * self.window, axis=-1)
+        psd = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        return psd[..., self.freq_slice]
+
+    def compute(self, inputs: list[tuple[str, NDArray[Float64], bool]],
+                start_position: Optional[int] = None) -> list[NDArray[Float64]]:
+        # inputs are (kind, data (channels x n_samples), linear detrend), all with the same channel count, and all
+        # their missing segments go through a single FFT.  Returns a (channels x n_freqs) PSD per input.
+        # start_position is the absolute stream position of sample 0; pass it to enable segment caching.
+        missing_keys = []
+        missing_segments = []
+        missing_linear = []
+        for kind, data, linear in inputs:
+            for offset in self.segment_offsets:
+                key = (kind, None if start_position is None else start_position + offset)
+                if start_position is None or key not in self.segment_cache:
+                    missing_keys.append((key, offset))
+                    missing_segments.append(data[:, offset:offset + self.n_per_seg])
+                    missing_linear.append(linear)
+
+        computed = {}
+        if missing_segments:
+            spectra = self._spectra(np.stack(missing_segments), np.array(missing_linear))
+            for ((kind, position), offset), spectrum in zip(missing_keys, spectra):
+                computed[(kind, offset)] = spectrum
+                if start_position is not None:
+                    self.segment_cache[(kind, position)] = spectrum
+
+        results = []
+        for kind, data, linear in inputs:
+            segment_psds = [computed[(kind, offset)] if (kind, offset) in computed
+                            else self.segment_cache[(kind, start_position + offset)]
+                            for offset in self.segment_offsets]
+            results.append(np.mean(segment_psds, axis=0))
+
+        if start_position is not None:
+            # Nothing before this window will be needed again
+            self.segment_cache = {key: value for key, value in self.segment_cache.items() if key[1] >= start_position}
+        return results
+
+
+def band_power_weights(freqs: NDArray[Float64]) -> NDArray[Float64]:
+    # Trapezoid integration weights, (n_freqs x n_bands), so all band powers for all channels are a single matmul.
+    # Same bin selection as Brainflow's get_band_power: every frequency within [low, high].
+    weights = np.zeros((len(freqs), len(BAND_DEFINITIONS)))
+    for band_idx, (low, high, _) in enumerate(BAND_DEFINITIONS):
+        indices = np.where((freqs >= low) & (freqs <= high))[0]
+        for a, b in zip(indices[:-1], indices[1:]):
+            dx = freqs[b] - freqs[a]
+            weights[a, band_idx] += dx / 2
+            weights[b, band_idx] += dx / 2
+    return weights
+
+
+class EpochProcessor:
+    # Processes a whole (channels x samples) epoch at once, replacing the per-channel MNE RawArray round trips
+    def __init__(self, sampling_rate: int, channel_names: List[str], complexity_pool: ComplexityPool,
+                 features: FeatureRegistry, welch_segment_samples: Optional[int] = None, welch_overlap_samples: int = 0,
+                 source: Optional[str] = None, artifact_threshold: float = 30, artifact_min_channels: int = 1):
+        self.sampling_rate = sampling_rate
+        # Which board this is processing for, when there are several
+        self.source = source
+        self.channel_names = channel_names
+        self.complexity_pool = complexity_pool
+        self.features = features
+        self.welch_segment_samples = welch_segment_samples
+        self.welch_overlap_samples = welch_overlap_samples
+        self.welch = None
+        self.band_weights = None
+        self.artifact_threshold = artifact_threshold
+        self.artifact_min_channels = artifact_min_channels
+        self.artifacts: Optional[ArtifactDetector] = None
+
+    def _welch_for(self, n_samples: int) -> WelchPsd:
+        if self.welch is None or self.welch.n_samples != n_samples:
+            self.welch = WelchPsd(self.sampling_rate, n_samples, self.welch_segment_samples, self.welch_overlap_samples)
+            self.band_weights = band_power_weights(self.welch.freqs)
+        return self.welch
+
+    def _artifacts_for(self, num_channels: int) -> ArtifactDetector:
+        if self.artifacts is None or self.artifacts.num_channels != num_channels:
+            self.artifacts = ArtifactDetector(num_channels, self.artifact_threshold, self.artifact_min_channels)
+        return self.artifacts
+
+    async def process(self, epoch_index: int, epoch: NDArray[Float64], filtered: NDArray[Float64],
+                      start_position: Optional[int] = None) -> EpochResult:
+        # Both are (channels x samples).  Filtering is done as samples arrive, by the StreamingFilterBank.
+        # Only the features enabled in the registry are computed, the rest are left as None/empty.
+        # start_position is the absolute position of the epoch in the stream.  When given, Welch segments already
+        # computed for an overlap with the last epoch are reused, and artifacts are tracked across epochs.  Without it
+        # epochs are assumed to follow on from each other.
+        features = self.features
+        features.start_epoch()
+        num_channels, n_samples = epoch.shape
+        welch = self._welch_for(n_samples)
+
+        # One batched Welch call for whichever of raw, band power signal and filtered are needed, for every channel.
+        # MNE produces clearer FFTs than Brainflow, and this matches MNE's output.
+        psd_inputs = []
+        if features.is_enabled(FFT_RAW):
+            psd_inputs.append((FFT_RAW, epoch, False))
+        if features.is_enabled(BAND_POWERS):
+            # Band powers are taken from the linearly detrended raw signal
+            psd_inputs.append((BAND_POWERS, epoch, True))
+        if features.is_enabled(FFT_FILTERED):
+            psd_inputs.append((FFT_FILTERED, filtered, False))
+
+        psds = {}
+        if psd_inputs:
+            with features.timed(PSD):
+                psds = dict(zip((kind for kind, _, _ in psd_inputs), welch.compute(psd_inputs, start_position)))
+        psds_raw = psds.get(FFT_RAW)
+        psds_filtered = psds.get(FFT_FILTERED)
+        band_powers = None
+        if BAND_POWERS in psds:
+            with features.timed(BAND_POWERS):
+                band_powers = psds[BAND_POWERS] @ self.band_weights
+
+        # Computed in worker processes so the event loop stays responsive
+        complexity_metrics = features.enabled_complexity_metrics()
+        if complexity_metrics:
+            with features.timed(COMPLEXITY):
+                complexity = await self.complexity_pool.compute(epoch_index, filtered, self.sampling_rate,
+                                                                complexity_metrics, features.timings_ms, self.source)
+        else:
+            complexity = [{} for _ in range(num_channels)]
+
+        artifacts = None
+        merged_artifacts = None
+        if features.is_enabled(THRESHOLD):
+            with features.timed(THRESHOLD):
+                detector = self._artifacts_for(num_channels)
+                position = start_position
+                if position is None:
+                    position = 0 if detector.position is None else detector.position
+                artifacts, merged_artifacts = detector.detect(filtered, position)
+
+        # The epoch is copied out of the ring buffers, once per block, as sinks may serialise it after the buffers
+        # have moved on
+        return EpochResult(list(range(num_channels)), self.channel_names, np.array(epoch), np.array(filtered),
+                           welch.freqs if psds_raw is not None or psds_filtered is not None else None,
+                           psds_raw, psds_filtered, band_powers, artifacts, merged_artifacts, complexity)
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import logging
+
+import numpy as np
+from nptyping import NDArray, Float64
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    # Preallocated (channels x capacity) float64 ring buffer.
+    # Every sample is written twice, at i and i + capacity, so any window of up to `capacity` samples starting at the
+    # read position is contiguous in memory and can be handed out as a view without copying.
+    def __init__(self, num_channels: int, capacity: int):
+        if capacity <= 0:
+            raise ValueError(f"Ring buffer capacity must be positive, got {capacity}")
+        self.num_channels = num_channels
+        self.capacity = capacity
+        self.data = np.zeros((num_channels, capacity * 2), dtype=np.float64)
+        self.read_pos = 0
+        self.available = 0
+        # Total samples ever written and dropped, so callers can track absolute sample positions
+        self.total_written = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.available
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self.available
+
+    def write(self, block: NDArray[Float64]):
+        n = block.shape[1]
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the newest `capacity` samples can ever be read back
+            self.drop(self.available)
+            self.dropped += n - self.capacity
+            self.total_written += n - self.capacity
+            block = block[:, -self.capacity:]
+            n = self.capacity
+        if n > self.free:
+            overflow = n - self.free
+            logger.warning(f"Ring buffer backlog exceeded {self.capacity} samples, dropping {overflow} oldest samples")
+            self.drop(overflow)
+
+        write_pos = (self.read_pos + self.available) % self.capacity
+        first = min(n, self.capacity - write_pos)
+        self._write_at(write_pos, block[:, :first])
+        if first < n:
+            self._write_at(0, block[:, first:])
+        self.available += n
+        self.total_written += n
+
+    def _write_at(self, pos: int, block: NDArray[Float64]):
+        n = block.shape[1]
+        self.data[:, pos:pos + n] = block
+        self.data[:, pos + self.capacity:pos + self.capacity + n] = block
+
+    def peek(self, n: int) -> NDArray[Float64]:
+        # Zero-copy view of the next n unread samples.  Only valid until the next write.
+        if n > self.available:
+            raise ValueError(f"Requested {n} samples but only {self.available} available")
+        return self.data[:, self.read_pos:self.read_pos + n]
+
+    def consume(self, n: int):
+        n = min(n, self.available)
+        self.read_pos = (self.read_pos + n) % self.capacity
+        self.available -= n
+
+    def drop(self, n: int):
+        n = min(n, self.available)
+        self.consume(n)
+        self.dropped += n
+
+    def clear(self):
+        self.read_pos = 0
+        self.available = 0
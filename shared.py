@@ -1,4 +1,6 @@
-from typing import List
+from __future__ import annotations
+
+from typing import List, Optional
 
 from nptyping import Float64, NDArray
 
@@ -14,36 +16,91 @@ BAND_DEFINITIONS = [
 
 BAND_NAMES = [band[2] for band in BAND_DEFINITIONS]
 
-class BandPowers:
-    def __init__(self, sdelta: float, fdelta: float, theta: float, alpha: float, sigma: float, beta: float):
-        self.sdelta = sdelta
-        self.fdelta = fdelta
-        self.theta = theta
-        self.alpha = alpha
-        self.sigma = sigma
-        self.beta = beta
-
-    def to_dict(self):
-        return {
-            "sdelta": self.sdelta,
-            "fdelta": self.fdelta,
-            "theta": self.theta,
-            "alpha": self.alpha,
-            "sigma": self.sigma,
-            "beta": self.beta,
-        }
-
-
-class PerChannel:
-    def __init__(self, channel_idx: int, channel_name: str, raw: NDArray[Float64], filtered: NDArray[Float64],
-                 fft_raw, fft_filtered, band_powers: BandPowers, over_threshold_indices: List[int], complexity):
-        # Non-Pythonic names as matching existing JSON
-        self.channelIdx = channel_idx
-        self.channelName = channel_name
+class EpochResult:
+    # One processed epoch for all of a board's channels.  Per-sample and per-frequency data are (channels x n) float64
+    # blocks, so sinks serialise each block in one go rather than walking per-channel objects.  Features that weren't
+    # computed are None.
+    __slots__ = ('channel_indices', 'channel_names', 'raw', 'filtered', 'freqs', 'fft_raw', 'fft_filtered',
+                 'band_powers', 'artifacts', 'merged_artifacts', 'complexity', 'raw_indices', 'filtered_indices',
+                 'decimation')
+
+    def __init__(self, channel_indices: List[int], channel_names: List[str], raw: NDArray[Float64],
+                 filtered: NDArray[Float64], freqs: Optional[NDArray[Float64]] = None,
+                 fft_raw: Optional[NDArray[Float64]] = None, fft_filtered: Optional[NDArray[Float64]] = None,
+                 band_powers: Optional[NDArray[Float64]] = None, artifacts: Optional[List[List[list]]] = None,
+                 merged_artifacts: Optional[List[list]] = None, complexity: Optional[List[dict]] = None,
+                 raw_indices: Optional[NDArray] = None, filtered_indices: Optional[NDArray] = None,
+                 decimation: Optional[dict] = None):
+        self.channel_indices = channel_indices
+        self.channel_names = channel_names
         self.raw = raw
         self.filtered = filtered
-        self.fftRaw = fft_raw
-        self.fftFiltered = fft_filtered
-        self.bandPowers = band_powers
-        self.overThresholdIndices = over_threshold_indices
-        self.complexity = complexity
+        # Shared by both spectra
+        self.freqs = freqs
+        self.fft_raw = fft_raw
+        self.fft_filtered = fft_filtered
+        # (channels x bands), in BAND_NAMES order
+        self.band_powers = band_powers
+        # Per channel runs of filtered samples over the artifact threshold, [start, end, peak], and the same merged
+        # across channels, see ArtifactDetector
+        self.artifacts = [[] for _ in channel_names] if artifacts is None else artifacts
+        self.merged_artifacts = merged_artifacts
+        # Per channel dicts of complexity metric values
+        self.complexity = [{} for _ in channel_names] if complexity is None else complexity
+        # When raw and filtered have been decimated for display, the (channels x n) sample index of each value, and
+        # {"method", "samples"} with the epoch's original length, see decimation.py
+        self.raw_indices = raw_indices
+        self.filtered_indices = filtered_indices
+        self.decimation = decimation
+
+    def __len__(self):
+        return len(self.channel_names)
+
+    @property
+    def num_samples(self) -> int:
+        return self.raw.shape[1]
+
+    def select(self, channel_names: frozenset[str]) -> EpochResult:
+        # A subset of the channels, e.g. for a client that only wants some
+        rows = [i for i, name in enumerate(self.channel_names) if name in channel_names]
+
+        def take(block):
+            return None if block is None else block[rows]
+
+        return EpochResult([self.channel_indices[i] for i in rows], [self.channel_names[i] for i in rows],
+                           take(self.raw), take(self.filtered), self.freqs, take(self.fft_raw), take(self.fft_filtered),
+                           take(self.band_powers), [self.artifacts[i] for i in rows], self.merged_artifacts,
+                           [self.complexity[i] for i in rows], take(self.raw_indices), take(self.filtered_indices),
+                           self.decimation)
+
+    def band_power_dicts(self) -> List[Optional[dict]]:
+        if self.band_powers is None:
+            return [None] * len(self)
+        return [dict(zip(BAND_NAMES, row)) for row in self.band_powers.tolist()]
+
+    def channel_dicts(self) -> List[dict]:
+        # The per-channel JSON, with the camelCase names clients expect.  Each block goes through tolist() once.
+        n = len(self)
+        raw = self.raw.tolist()
+        filtered = self.filtered.tolist()
+        freqs = None if self.freqs is None else self.freqs.tolist()
+        fft_raw = [None] * n if self.fft_raw is None else [{"freq": freqs, "power": power} for power in self.fft_raw.tolist()]
+        fft_filtered = [None] * n if self.fft_filtered is None else \
+            [{"freq": freqs, "power": power} for power in self.fft_filtered.tolist()]
+        band_powers = self.band_power_dicts()
+        channels = [{
+            'channelIdx': self.channel_indices[i],
+            'channelName': self.channel_names[i],
+            'raw': raw[i],
+            'filtered': filtered[i],
+            'fftRaw': fft_raw[i],
+            'fftFiltered': fft_filtered[i],
+            'bandPowers': band_powers[i],
+            'artifacts': self.artifacts[i],
+            'complexity': self.complexity[i],
+        } for i in range(n)]
+        if self.raw_indices is not None:
+            for channel, raw_indices, filtered_indices in zip(channels, self.raw_indices.tolist(), self.filtered_indices.tolist()):
+                channel['rawIndices'] = raw_indices
+                channel['filteredIndices'] = filtered_indices
+        return channels
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+from nptyping import NDArray, Float64
+
+from complexity import COMPLEXITY_COLUMNS
+from shared import EpochResult, BAND_NAMES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x42574156
+VERSION = 1
+
+# The header is int64 fields at the start of the segment
+HEADER_FIELDS = 16
+_MAGIC, _VERSION, _NUM_CHANNELS, _CAPACITY, _EPOCH_CAPACITY, _EPOCH_FIELDS, _METADATA_BYTES, _CLOSED, \
+    _WRITING, _WRITTEN, _EPOCHS_WRITING, _EPOCHS_WRITTEN = range(12)
+# Per epoch record: epoch index, stream position of its first sample, board timestamp of it, then the band powers and
+# complexity metrics per channel
+EPOCH_PREFIX = 3
+
+
+def _layout(num_channels: int, capacity: int, epoch_capacity: int, epoch_fields: int, metadata_bytes: int) -> tuple[int, int, int]:
+    # Offsets of the samples and epochs blocks, and the total size
+    samples_offset = HEADER_FIELDS * 8 + (metadata_bytes + 7) // 8 * 8
+    epochs_offset = samples_offset + (2 * num_channels + 1) * 2 * capacity * 8
+    return samples_offset, epochs_offset, epochs_offset + epoch_capacity * epoch_fields * 8
+
+
+def _views(buf, num_channels: int, capacity: int, epoch_capacity: int, epoch_fields: int, metadata_bytes: int):
+    samples_offset, epochs_offset, _ = _layout(num_channels, capacity, epoch_capacity, epoch_fields, metadata_bytes)
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=buf)
+    # Raw channels, then filtered channels, then timestamps, as rows
+    samples = np.ndarray((2 * num_channels + 1, 2 * capacity), dtype=np.float64, buffer=buf, offset=samples_offset)
+    epochs = np.ndarray((epoch_capacity, epoch_fields), dtype=np.float64, buffer=buf, offset=epochs_offset)
+    return header, samples, epochs
+
+
+class SharedRingWriter:
+    # Publishes a board's raw and filtered samples, their timestamps and per-epoch features into a named
+    # multiprocessing.shared_memory segment, for local processes to read with SharedRingReader without any copying or
+    # serialisation.
+    # As in RingBuffer every sample is written twice, at i and i + capacity, so any window of up to capacity samples is
+    # contiguous.  Positions are absolute sample counts since the writer was created.  Each write bumps a 'writing'
+    # counter before touching the data and a 'written' one after, so a reader can tell whether what it read was
+    # overwritten meanwhile (a seqlock).  There are no memory barriers from Python, so this relies on the stores being
+    # seen in order, as they are on x86.
+    def __init__(self, name: str, channel_names: list[str], sampling_rate: int, capacity: int,
+                 epoch_capacity: int = 256, source: Optional[str] = None):
+        self.name = name
+        self.channel_names = channel_names
+        self.num_channels = len(channel_names)
+        self.capacity = capacity
+        self.epoch_capacity = epoch_capacity
+        metadata = json.dumps({'channels': channel_names, 'samplingRate': sampling_rate, 'bands': BAND_NAMES,
+                               'complexity': COMPLEXITY_COLUMNS, 'source': source}).encode('utf-8')
+        epoch_fields = EPOCH_PREFIX + self.num_channels * (len(BAND_NAMES) + len(COMPLEXITY_COLUMNS))
+        size = _layout(self.num_channels, capacity, epoch_capacity, epoch_fields, len(metadata))[2]
+
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a process that didn't exit cleanly
+            logger.warning(f"Replacing existing shared memory {name}")
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self.header, self.samples, self.epochs = _views(self.shm.buf, self.num_channels, capacity, epoch_capacity,
+                                                        epoch_fields, len(metadata))
+        self.shm.buf[HEADER_FIELDS * 8:HEADER_FIELDS * 8 + len(metadata)] = metadata
+        self.header[:] = 0
+        self.header[_VERSION] = VERSION
+        self.header[_NUM_CHANNELS] = self.num_channels
+        self.header[_CAPACITY] = capacity
+        self.header[_EPOCH_CAPACITY] = epoch_capacity
+        self.header[_EPOCH_FIELDS] = epoch_fields
+        self.header[_METADATA_BYTES] = len(metadata)
+        # Last, so readers never see a half initialised header
+        self.header[_MAGIC] = MAGIC
+        logger.info(f"Publishing to shared memory {name} ({size / 1e6:.1f}MB, {capacity} samples)")
+
+    @property
+    def written(self) -> int:
+        return int(self.header[_WRITTEN])
+
+    def write(self, raw: NDArray[Float64], filtered: NDArray[Float64], timestamps: NDArray[Float64]):
+        # raw and filtered are (channels x samples), timestamps (samples,)
+        n = raw.shape[1]
+        if n == 0:
+            return
+        written = self.written
+        end = written + n
+        if n > self.capacity:
+            # Only the newest capacity samples could ever be read
+            raw, filtered, timestamps = raw[:, -self.capacity:], filtered[:, -self.capacity:], timestamps[-self.capacity:]
+            n = self.capacity
+        self.header[_WRITING] = end
+        pos = (end - n) % self.capacity
+        first = min(n, self.capacity - pos)
+        self._write_at(pos, raw[:, :first], filtered[:, :first], timestamps[:first])
+        if first < n:
+            self._write_at(0, raw[:, first:], filtered[:, first:], timestamps[first:])
+        self.header[_WRITTEN] = end
+
+    def _write_at(self, pos: int, raw: NDArray[Float64], filtered: NDArray[Float64], timestamps: NDArray[Float64]):
+        n = raw.shape[1]
+        for start in (pos, pos + self.capacity):
+            self.samples[:self.num_channels, start:start + n] = raw
+            self.samples[self.num_channels:-1, start:start + n] = filtered
+            self.samples[-1, start:start + n] = timestamps
+
+    def write_epoch(self, epoch_index: int, position: int, timestamp: float, result: EpochResult):
+        # position is the stream position of the epoch's first sample.  Missing values are NaN.
+        index = int(self.header[_EPOCHS_WRITTEN])
+        self.header[_EPOCHS_WRITING] = index + 1
+        record = self.epochs[index % self.epoch_capacity]
+        record[:EPOCH_PREFIX] = (epoch_index, position, timestamp)
+        num_bands = self.num_channels * len(BAND_NAMES)
+        bands = record[EPOCH_PREFIX:EPOCH_PREFIX + num_bands]
+        bands[:] = np.nan if result.band_powers is None else result.band_powers.ravel()
+        complexity = record[EPOCH_PREFIX + num_bands:].reshape(self.num_channels, len(COMPLEXITY_COLUMNS))
+        for row, values in zip(complexity, result.complexity):
+            row[:] = [values.get(column, np.nan) for column in COMPLEXITY_COLUMNS]
+        self.header[_EPOCHS_WRITTEN] = index + 1
+
+    def close(self):
+        # Readers already attached keep their mapping, and can see that it's finished with
+        self.header[_CLOSED] = 1
+        del self.header, self.samples, self.epochs
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching registers the segment with this process's resource tracker, which would unlink
+        # it from under the writer when the reader exits
+        shm = shared_memory.SharedMemory(name)
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedRingReader:
+    # Reads a SharedRingWriter's segment from another process, e.g. a notebook:
+    #   reader = SharedRingReader("brainwave")
+    #   position, raw, filtered, timestamps = reader.latest(250)
+    # The arrays returned by read and latest are views straight into shared memory, which the writer overwrites once
+    # it's capacity samples further on; intact(position) says whether that has happened yet, and copy() checks it for
+    # you.  Readers track their own position, so any number can read at their own pace.
+    def __init__(self, name: str):
+        self.name = name
+        self.shm = _attach(name)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        if header[_MAGIC] != MAGIC:
+            raise ValueError(f"Shared memory {name} isn't a Brainwave ring, or isn't initialised yet")
+        if header[_VERSION] != VERSION:
+            raise ValueError(f"Shared memory {name} is version {header[_VERSION]}, expected {VERSION}")
+        self.num_channels = int(header[_NUM_CHANNELS])
+        self.capacity = int(header[_CAPACITY])
+        self.epoch_capacity = int(header[_EPOCH_CAPACITY])
+        metadata_bytes = int(header[_METADATA_BYTES])
+        metadata = json.loads(bytes(self.shm.buf[HEADER_FIELDS * 8:HEADER_FIELDS * 8 + metadata_bytes]))
+        self.channel_names: list[str] = metadata['channels']
+        self.sampling_rate: int = metadata['samplingRate']
+        self.band_names: list[str] = metadata['bands']
+        self.complexity_names: list[str] = metadata['complexity']
+        self.source: Optional[str] = metadata['source']
+        self.header, self.samples, self.epochs = _views(self.shm.buf, self.num_channels, self.capacity,
+                                                        self.epoch_capacity, int(header[_EPOCH_FIELDS]), metadata_bytes)
+
+    @property
+    def written(self) -> int:
+        # Position after the newest sample
+        return int(self.header[_WRITTEN])
+
+    @property
+    def oldest(self) -> int:
+        # Position of the oldest sample still readable
+        return max(0, int(self.header[_WRITING]) - self.capacity)
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.header[_CLOSED])
+
+    def intact(self, position: int) -> bool:
+        # Whether samples from position on haven't been overwritten (or started to be)
+        return position >= self.oldest
+
+    def read(self, position: int, n: int) -> tuple[NDArray[Float64], NDArray[Float64], NDArray[Float64]]:
+        # Views of raw and filtered (channels x n) and timestamps (n,) from position
+        if not self.oldest <= position <= self.written - n:
+            raise ValueError(f"Samples {position} to {position + n} aren't available, only {self.oldest} to {self.written}")
+        start = position % self.capacity
+        block = self.samples[:, start:start + n]
+        return block[:self.num_channels], block[self.num_channels:-1], block[-1]
+
+    def latest(self, n: int) -> tuple[int, NDArray[Float64], NDArray[Float64], NDArray[Float64]]:
+        # The newest n samples, and the position of the first
+        position = self.written - n
+        return (position, *self.read(position, n))
+
+    def copy(self, position: int, n: int) -> tuple[NDArray[Float64], NDArray[Float64], NDArray[Float64]]:
+        # As read, but copies that are checked not to have been overwritten while copying
+        raw, filtered, timestamps = (np.array(a) for a in self.read(position, n))
+        if not self.intact(position):
+            raise ValueError(f"Samples from {position} were overwritten while being copied")
+        return raw, filtered, timestamps
+
+    def wait(self, position: int, timeout: Optional[float] = None, poll_interval: float = 0.005) -> bool:
+        # Polls until samples up to position have been written, or the timeout passes
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.written < position:
+            if self.closed or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    @property
+    def epochs_written(self) -> int:
+        return int(self.header[_EPOCHS_WRITTEN])
+
+    def epoch(self, index: int) -> Optional[dict]:
+        # The index'th epoch written (from 0), copied, or None if it's been overwritten.  bandPowers is (channels x
+        # bands) and complexity (channels x metrics), NaN where a value wasn't computed.
+        if not max(0, self.epochs_written - self.epoch_capacity) <= index < self.epochs_written:
+            return None
+        record = np.array(self.epochs[index % self.epoch_capacity])
+        if int(self.header[_EPOCHS_WRITING]) - self.epoch_capacity > index:
+            return None
+        num_bands = self.num_channels * len(self.band_names)
+        return {
+            'epoch': int(record[0]),
+            'position': int(record[1]),
+            'timestamp': float(record[2]),
+            'bandPowers': record[EPOCH_PREFIX:EPOCH_PREFIX + num_bands].reshape(self.num_channels, len(self.band_names)),
+            'complexity': record[EPOCH_PREFIX + num_bands:].reshape(self.num_channels, len(self.complexity_names)),
+        }
+
+    def latest_epoch(self) -> Optional[dict]:
+        return self.epoch(self.epochs_written - 1)
+
+    def close(self):
+        del self.header, self.samples, self.epochs
+        self.shm.close()
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import io
+import logging
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Optional
+
+import numpy as np
+from nptyping import NDArray, Float64
+
+from ring_buffer import RingBuffer
+from shared import EpochResult, BAND_NAMES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SPINDLES = "spindles"
+SLOW_WAVES = "slow_waves"
+DETECTIONS = [SPINDLES, SLOW_WAVES]
+# yasa warns that staging is unreliable on less, and can't stage much shorter recordings at all
+STAGING_MIN_SECONDS = 300
+
+
+@functools.lru_cache(maxsize=None)
+def _yasa():
+    # yasa pulls in mne, sklearn and lightgbm, so it's only imported in the worker that needs it.  Cached, so the
+    # logging setup is only done once per worker.
+    import warnings
+    import mne
+    import yasa
+    mne.set_log_level('ERROR')
+    # yasa passes verbose=0 to mne's filtering, which resets the level above, so filter its INFO chatter too
+    logging.getLogger('mne').addFilter(lambda record: record.levelno >= logging.WARNING)
+    # The bundled classifiers were pickled with an older sklearn, which it warns about each time
+    warnings.filterwarnings('ignore', module='sklearn')
+    return yasa
+
+
+def _warm_up_worker():
+    # Returns nothing, as the yasa module can't be pickled back
+    _yasa()
+
+
+def _log_warm_up_error(future):
+    if future.exception() is not None:
+        logger.error(f"Error loading yasa: {future.exception()}")
+
+
+def warm_up(executor: Executor):
+    # Imports yasa in the worker ahead of the first window, as that takes several seconds
+    executor.submit(_warm_up_worker).add_done_callback(_log_warm_up_error)
+
+
+def detection_summary(results, channel_names: list[str], minutes: float) -> dict:
+    # Per channel count and density (per minute) of yasa spindle or slow wave detections, which are None if none
+    counts = dict.fromkeys(channel_names, 0)
+    if results is not None:
+        counts.update(results.summary()['Channel'].value_counts().to_dict())
+    return {'count': counts, 'density': {name: count / minutes for name, count in counts.items()}}
+
+
+def analyse_window(raw: NDArray[Float64], sampling_rate: int, channel_names: list[str], window_samples: int,
+                   staging_channel: Optional[str], detections: list[str]) -> dict:
+    # Runs in a worker process.  raw is the (channels x samples) history in uV, ending with the latest window.  Staging
+    # uses all of it, as yasa's features look at the surrounding minutes; detections just the latest window.
+    yasa = _yasa()
+    results = {}
+    if staging_channel is not None and raw.shape[1] >= STAGING_MIN_SECONDS * sampling_rate:
+        import mne
+        info = mne.create_info([staging_channel], sampling_rate, 'eeg')
+        # yasa expects volts
+        history = mne.io.RawArray(raw[[channel_names.index(staging_channel)]] * 1e-6, info)
+        probabilities = yasa.SleepStaging(history, staging_channel).predict_proba().iloc[-1]
+        results['stage'] = probabilities.idxmax()
+        results['stageProbabilities'] = {stage: float(p) for stage, p in probabilities.items()}
+
+    latest = raw[:, -window_samples:]
+    minutes = window_samples / sampling_rate / 60
+    # The same verbose=0 turns on joblib's progress output, which goes straight to stderr
+    with contextlib.redirect_stderr(io.StringIO()):
+        if SPINDLES in detections:
+            spindles = yasa.spindles_detect(latest, sampling_rate, channel_names, verbose='ERROR')
+            results['spindles'] = detection_summary(spindles, channel_names, minutes)
+        if SLOW_WAVES in detections:
+            slow_waves = yasa.sw_detect(latest, sampling_rate, channel_names, verbose='ERROR')
+            results['slowWaves'] = detection_summary(slow_waves, channel_names, minutes)
+    return results
+
+
+class SleepAnalyser:
+    # Long-horizon analysis alongside the per-epoch processing, for overnight recordings.  Every window_seconds (30s,
+    # the standard scoring epoch) it reports:
+    #   bandPowers, relativeBandPowers  per channel, the mean of the epochs' band powers.  Welch's PSD is itself a mean
+    #                                   of segment PSDs, so this is the window's Welch band power without recomputing
+    #                                   any FFTs.
+    #   history                         the same averaged over the last history_minutes
+    #   stage, stageProbabilities       yasa's sleep stage for the window, once there's enough history
+    #   spindles, slowWaves             yasa detections in the window
+    # yasa runs on the executor, at most one window at a time; if it's still busy with the last window the next is
+    # reported without it.  Results are passed to on_results with the source (board).
+    def __init__(self, sampling_rate: int, channel_names: list[str],
+                 on_results: Callable[[dict, Optional[str]], None], executor: Optional[Executor] = None,
+                 window_seconds: float = 30, history_minutes: float = 10, staging_channel: Optional[str] = None,
+                 detections: Optional[list[str]] = None, source: Optional[str] = None):
+        self.sampling_rate = sampling_rate
+        self.channel_names = channel_names
+        self.on_results = on_results
+        self.executor = executor
+        self.source = source
+        self.window_samples = int(window_seconds * sampling_rate)
+        if staging_channel is not None and staging_channel not in channel_names:
+            logger.warning(f"Sleep staging channel {staging_channel} not found in {channel_names}, not staging")
+            staging_channel = None
+        self.staging_channel = staging_channel
+        self.detections = detections or []
+        # Raw samples for yasa, each written once
+        history_samples = max(self.window_samples, int(history_minutes * 60 * sampling_rate))
+        self.raw = RingBuffer(len(channel_names), history_samples)
+        # Summaries of past windows, for the rolling aggregates
+        self.history: deque[NDArray[Float64]] = deque(maxlen=max(1, int(history_minutes * 60 / window_seconds)))
+
+        self.window_index = 0
+        self.window_start: Optional[float] = None
+        self.window_samples_seen = 0
+        self.band_powers_sum: Optional[NDArray[Float64]] = None
+        self.epochs_in_window = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def uses_worker(self) -> bool:
+        return self.executor is not None and (self.staging_channel is not None or bool(self.detections))
+
+    def add_epoch(self, result: EpochResult, new_raw: NDArray[Float64], timestamps: NDArray[Float64]):
+        # new_raw is the samples this epoch consumed (the hop in sliding window mode), with their board timestamps
+        if self.window_start is None:
+            self.window_start = float(timestamps[0])
+        # Oldest history is overwritten once full
+        self.raw.drop(max(0, new_raw.shape[1] - self.raw.free))
+        self.raw.write(new_raw)
+        self.window_samples_seen += new_raw.shape[1]
+        if result.band_powers is not None:
+            self.band_powers_sum = result.band_powers if self.band_powers_sum is None else self.band_powers_sum + result.band_powers
+            self.epochs_in_window += 1
+
+        if self.window_samples_seen >= self.window_samples:
+            self.close_window(float(timestamps[-1]))
+
+    def close_window(self, end: float):
+        self.window_index += 1
+        summary = {'window': self.window_index, 'start': self.window_start, 'end': end, 'channels': self.channel_names}
+        if self.epochs_in_window:
+            band_powers = self.band_powers_sum / self.epochs_in_window
+            self.history.append(band_powers)
+            summary.update(self.band_power_summary(band_powers))
+            summary['history'] = {'windows': len(self.history), **self.band_power_summary(np.mean(self.history, axis=0))}
+
+        self.window_start = None
+        self.window_samples_seen = 0
+        self.band_powers_sum = None
+        self.epochs_in_window = 0
+
+        if not self.uses_worker:
+            self.on_results(summary, self.source)
+        elif self.task is not None and not self.task.done():
+            logger.warning(f"Sleep analysis of the last window still running, skipping it for window {self.window_index}")
+            self.on_results(summary, self.source)
+        else:
+            # Copied, as the ring buffer keeps being written while the worker has it
+            raw = np.array(self.raw.peek(len(self.raw)))
+            self.task = asyncio.create_task(self.analyse(summary, raw))
+
+    async def analyse(self, summary: dict, raw: NDArray[Float64]):
+        loop = asyncio.get_running_loop()
+        try:
+            summary.update(await loop.run_in_executor(self.executor, analyse_window, raw, self.sampling_rate,
+                                                      self.channel_names, self.window_samples, self.staging_channel,
+                                                      self.detections))
+        except Exception as e:
+            logger.error(f"Error in sleep analysis: {e}")
+        self.on_results(summary, self.source)
+
+    @staticmethod
+    def band_power_summary(band_powers: NDArray[Float64]) -> dict:
+        # Relative to the total over all bands, as yasa.bandpower_from_psd does
+        total = band_powers.sum(axis=1, keepdims=True)
+        relative = np.divide(band_powers, total, out=np.zeros_like(band_powers), where=total > 0)
+        return {
+            'bandPowers': [dict(zip(BAND_NAMES, row)) for row in band_powers.tolist()],
+            'relativeBandPowers': [dict(zip(BAND_NAMES, row)) for row in relative.tolist()],
+        }
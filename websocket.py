@@ -1,42 +1,133 @@
 import asyncio
+import time
+from collections import deque
 
 import websockets
 import logging
 import json
 import ssl
-from typing import Callable, List
+from typing import Callable, List, Optional
 
+from binary_format import encode_eeg_frame
+from decimation import parse_view, apply_view
+from json_format import CustomEncoder
+from metrics import Metrics
+from shared import EpochResult
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+
+class WebsocketClient:
+    # A connected client: what it has subscribed to, and its own bounded send queue drained by its own task, so a slow
+    # client only ever delays itself.  When the queue is full the oldest message is dropped.
+    def __init__(self, websocket, max_queue_size: int, metrics: Metrics):
+        self.websocket = websocket
+        self.name = str(getattr(websocket, 'remote_address', id(websocket)))
+        # Format it wants 'eeg' messages in, negotiated with the 'format' command
+        self.format = FORMAT_JSON
+        # None means everything
+        self.addresses: Optional[set[str]] = None
+        self.channels: Optional[set[str]] = None
+        self.boards: Optional[set[str]] = None
+        # Resolution it wants 'eeg' messages at, set with the 'view' command, see decimation.parse_view.  None is full.
+        self.view: Optional[tuple] = None
+        self.max_queue_size = max_queue_size
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.queue: deque[tuple[float, object]] = deque()
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.last_lag_ms = 0.0
+        self.sender_task = asyncio.create_task(self.run_sender())
+
+    def wants(self, address: str) -> bool:
+        return self.addresses is None or address in self.addresses
+
+    def wants_board(self, board: Optional[str]) -> bool:
+        return self.boards is None or board is None or board in self.boards
+
+    def enqueue(self, message):
+        if len(self.queue) >= self.max_queue_size:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append((time.perf_counter(), message))
+        self.wakeup.set()
+
+    async def run_sender(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                enqueued_at, message = self.queue.popleft()
+                with self.metrics.time("websocket_send"):
+                    await self.websocket.send(message)
+                self.sent += 1
+                lag = time.perf_counter() - enqueued_at
+                self.last_lag_ms = lag * 1000
+                self.metrics.observe("websocket_lag", lag)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.error(f"Error sending to WebSocket client {self.name}: {e}")
+
+    def close(self):
+        self.sender_task.cancel()
+
+    def stats(self) -> dict:
+        oldest_ms = (time.perf_counter() - self.queue[0][0]) * 1000 if self.queue else 0.0
+        return {
+            'client': self.name,
+            'format': self.format,
+            'addresses': None if self.addresses is None else sorted(self.addresses),
+            'channels': None if self.channels is None else sorted(self.channels),
+            'boards': None if self.boards is None else sorted(self.boards),
+            'view': self.view,
+            'queued': len(self.queue),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            # How long the oldest queued message has waited, or if nothing is queued, how long the last one waited
+            'lagMs': oldest_ms if self.queue else self.last_lag_ms,
+        }
+
+
 class WebsocketHandler:
-    def __init__(self, ssl_cert, ssl_key, on_start, on_stop, on_quit, emit_event_callback: Callable[[str, float], None]):
+    def __init__(self, ssl_cert, ssl_key, on_start, on_stop, on_quit, emit_event_callback: Callable[[str, float], None], on_features: Callable[[List[str], List[str]], dict], max_queue_size: int = 16, metrics: Optional[Metrics] = None):
         self.ssl_cert = ssl_cert
         self.ssl_key = ssl_key
         self.servers = []
-        self.clients = set()
+        # websocket -> WebsocketClient
+        self.clients = {}
+        self.max_queue_size = max_queue_size
+        self.metrics = metrics if metrics is not None else Metrics()
         self.board = None
         self.done = False
         self.on_start = on_start
         self.on_stop = on_stop
         self.on_quit = on_quit
         self.emit_event_callback = emit_event_callback
+        self.on_features = on_features
         self.shutdown_signal = asyncio.Event()
 
     async def handle_websocket(self, websocket, path = "/"):
         logger.info(f"WebSocket connection established with {path}")
-        self.clients.add(websocket)
+        self.clients[websocket] = WebsocketClient(websocket, self.max_queue_size, self.metrics)
         try:
             async for message in websocket:
                 logger.info(f"Message from {path}: {message}")
-                await self.process_websocket_message(message)
+                await self.process_websocket_message(message, websocket)
         except websockets.exceptions.ConnectionClosed as e:
             logger.warning(f"WebSocket connection with {path} closed: {e}")
         except Exception as e:
             logger.error(f"Error in WebSocket connection with {path}: {e}")
         finally:
-            self.clients.remove(websocket)
+            client = self.clients.pop(websocket, None)
+            if client is not None:
+                client.close()
             logger.info(f"WebSocket connection with {path} terminated")
 
     async def start_websocket_server(self, port):
@@ -62,49 +153,142 @@ class WebsocketHandler:
             
         await self.shutdown_signal.wait()
         for server in self.servers:
-            await server.close()
+            server.close()
+            await server.wait_closed()
 
     def stop(self):
         self.shutdown_signal.set()
 
-    async def process_websocket_message(self, message):
+    async def process_websocket_message(self, message, websocket=None):
         try:
             msg = json.loads(message)
             logger.info(f"Command received: {message}")
             await self.broadcast_websocket_message(json.dumps({
                 'address': 'log',
                 'message': f"Command '{message}' received"
-            }))
+            }), 'log')
             if msg['command'] == 'start':
+                # With several boards, "board" picks one, otherwise all are started
                 logger.info('Starting')
-                if 'channels' not in msg:
-                    self.on_start(None)
-                else:
-                    self.on_start(msg['channels'])
+                self.on_start(msg.get('channels'), msg.get('board'))
             elif msg['command'] == 'stop':
                 logger.info('Stopping recording')
-                self.on_stop()
+                self.on_stop(msg.get('board'))
             elif msg['command'] == 'quit':
                 logger.info('Quitting')
                 self.on_quit()
+            elif msg['command'] == 'format':
+                # e.g. {"command": "format", "format": "binary"}, see binary_format.py for the frame layout
+                if msg['format'] not in (FORMAT_JSON, FORMAT_BINARY):
+                    raise ValueError(f"Unknown format {msg['format']}")
+                if websocket in self.clients:
+                    self.clients[websocket].format = msg['format']
+            elif msg['command'] == 'subscribe':
+                # e.g. {"command": "subscribe", "addresses": ["eeg", "brainflow_event"], "channels": ["F3"], "boards": ["cyton"]}
+                # Missing or null addresses/channels/boards means all of them.  Channels and boards only filter 'eeg'
+                # messages.
+                if websocket in self.clients:
+                    client = self.clients[websocket]
+                    addresses = msg.get('addresses')
+                    channels = msg.get('channels')
+                    boards = msg.get('boards')
+                    client.addresses = None if addresses is None else set(addresses) | {'log'}
+                    client.channels = None if channels is None else set(channels)
+                    client.boards = None if boards is None else set(boards)
+            elif msg['command'] == 'view':
+                # e.g. {"command": "view", "points": 500, "decimation": "lttb", "fmin": 0, "fmax": 40, "bins": 64}
+                # Decimates raw and filtered to about points samples per channel ("minmax" by default, or "lttb"),
+                # and trims the spectra to fmin-fmax Hz averaged into at most bins bins.  Each is optional, and
+                # without any the full epoch is sent.
+                view = parse_view(msg)
+                if websocket in self.clients:
+                    self.clients[websocket].view = view
+            elif msg['command'] == 'clients':
+                await self.broadcast_websocket_message(json.dumps({
+                    'address': 'clients',
+                    'clients': self.client_stats()
+                }), 'clients')
+            elif msg['command'] == 'features':
+                # e.g. {"command": "features", "enable": ["sample_entropy"], "disable": ["fft_raw"]}
+                # With neither, just reports the enabled features and their last per-epoch timings
+                status = self.on_features(msg.get('enable', []), msg.get('disable', []))
+                await self.broadcast_websocket_message(json.dumps({
+                    'address': 'features',
+                    **status
+                }), 'features')
             else:
                 logger.warning('Unknown command')
             await self.broadcast_websocket_message(json.dumps({
                 'address': 'log',
                 'status': 'success',
                 'message': f"Command '{msg['command']}' processed"
-            }))
+            }), 'log')
         except Exception as error:
             logger.error(f'Error processing message: {error}')
             await self.broadcast_websocket_message(json.dumps({
                 'address': 'log',
                 'status': 'error',
                 'message': f"Command '{message}' failed"
-            }))
+            }), 'log')
+
+    async def broadcast_websocket_message(self, message, address: str):
+        # Never blocks on a client, just queues the message for every client subscribed to the address
+        for client in list(self.clients.values()):
+            if client.wants(address):
+                client.enqueue(message)
+
+    async def broadcast_eeg(self, result: EpochResult, epoch_index: int, board: Optional[str] = None):
+        # Each variant (format, channel subset, view) is only computed and serialised if some client wants it, and then
+        # only once, with the decimated views shared between formats
+        with self.metrics.time("websocket_broadcast"):
+            views = {}
+            variants = {}
+            for client in list(self.clients.values()):
+                if not client.wants('eeg') or not client.wants_board(board):
+                    continue
+                channels = None if client.channels is None else frozenset(client.channels)
+                key = (client.format, channels, client.view)
+                if key not in variants:
+                    if (channels, client.view) not in views:
+                        with self.metrics.time("websocket_view"):
+                            views[(channels, client.view)] = self.view_of(result, channels, client.view)
+                    with self.metrics.time(f"{client.format}_encode"):
+                        variants[key] = self.encode_eeg(views[(channels, client.view)], epoch_index, client.format, board)
+                client.enqueue(variants[key])
+
+    @staticmethod
+    def view_of(result: EpochResult, channels: Optional[frozenset[str]], view: Optional[tuple]) -> EpochResult:
+        # Channels first, so only those are decimated
+        if channels is not None:
+            result = result.select(channels)
+        if view is not None:
+            result = apply_view(result, view)
+        return result
+
+    def encode_eeg(self, result: EpochResult, epoch_index: int, format: str, board: Optional[str] = None):
+        if format == FORMAT_BINARY:
+            return encode_eeg_frame(result, epoch_index, board)
+        message = {
+            'address': 'eeg',
+            'epoch': epoch_index,
+            'data': result.channel_dicts()
+        }
+        if board is not None:
+            message['board'] = board
+        if result.merged_artifacts is not None:
+            message['artifacts'] = result.merged_artifacts
+        if result.decimation is not None:
+            message['decimation'] = result.decimation
+        return json.dumps(message, cls=CustomEncoder)
+
+    def client_stats(self) -> list[dict]:
+        return [client.stats() for client in list(self.clients.values())]
 
-    async def broadcast_websocket_message(self, message):
-        for client in self.clients:
-            await client.send(message)
+    def update_metrics(self):
+        clients = list(self.clients.values())
+        self.metrics.set_gauge("websocket_clients", len(clients))
+        self.metrics.set_gauge("websocket_queued", sum(len(client.queue) for client in clients))
+        self.metrics.set_gauge("websocket_dropped", sum(client.dropped for client in clients))
 
     def emit_event(self, event_name: str, timestamp: float):
         asyncio.create_task(self.emit_event_callback(event_name, timestamp))